@@ -31,12 +31,28 @@ newer Relion3.1 routines and old ones.
 """
 
 import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from emtable import Table
 import logging
 logger = logging.getLogger(__name__)
 
 import pyworkflow.utils as pwutils
+from pyworkflow.object import Float, Integer
 from pwem.constants import NO_INDEX
+from pwem.objects import Coordinate
+
+
+# Autopicking labels stored as extra attributes of the coordinates
+COORD_EXTRA_LABELS = [
+    ('rlnAutopickFigureOfMerit', Float),
+    ('rlnClassNumber', Integer),
+    ('rlnAnglePsi', Float)
+]
+
+# Minimum number of coordinate files read by each process, for fewer
+# files starting the processes takes longer than reading them
+COORD_FILES_PER_PROCESS = 16
 
 
 def openStar(fn, extraLabels=False):
@@ -241,3 +257,142 @@ def writeMicCoordinates(mic, coordList, outputFn, getPosFunc=None):
                        coord._rlnAnglePsi))
 
     f.close()
+
+
+def _readCoordinateColumns(coordFn):
+    """ Return a dict with the values of the coordinates columns of the
+    star file, or None if it could not be read. """
+    if not os.path.exists(coordFn):
+        logger.warning(f"WARNING: Missing coordinates star file: {coordFn}")
+        return None
+    try:
+        table = Table(fileName=coordFn)
+        labels = ['rlnCoordinateX', 'rlnCoordinateY']
+        labels += [label for label, _ in COORD_EXTRA_LABELS
+                   if table.hasColumn(label)]
+        return {label: table.getColumnValues(label) for label in labels}
+    except Exception:
+        logger.warning(f"WARNING: Error reading coordinates star file: {coordFn}")
+        return None
+
+
+def _iterCoordinateColumns(coordFiles, numberOfThreads):
+    """ Yield the columns of each coordinates file, in the input order.
+    Parsing star files is CPU bound and holds the GIL, so the files are
+    read by a pool of processes instead of threads. """
+    processes = min(numberOfThreads,
+                    len(coordFiles) // COORD_FILES_PER_PROCESS)
+    if processes < 2:
+        yield from map(_readCoordinateColumns, coordFiles)
+        return
+
+    chunksize = max(1, len(coordFiles) // (4 * processes))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # map returns the results in the same order than the input files
+        yield from executor.map(_readCoordinateColumns, coordFiles,
+                                chunksize=chunksize)
+
+
+def readCoordinateFiles(coordSet, micList, coordFiles, numberOfThreads=1,
+                        postprocessCoord=None):
+    """ Read many coordinate star files (one per micrograph) into a
+    SetOfCoordinates. If more than one thread is given and there are
+    enough files, they are parsed concurrently in other processes.
+    Params:
+        coordSet: SetOfCoordinates to be populated.
+        micList: micrographs, same length and order than coordFiles.
+        coordFiles: star files with the coordinates of each micrograph.
+        numberOfThreads: number of processes reading files at the same time.
+        postprocessCoord: optional function called with each coordinate
+            before it is appended.
+    """
+    micColumns = list(zip(micList, _iterCoordinateColumns(coordFiles,
+                                                          numberOfThreads)))
+
+    # All coordinates of the set must have the same attributes, the extra
+    # columns missing in some files are stored as None for their coordinates
+    extraLabels = [(label, AttrClass) for label, AttrClass in COORD_EXTRA_LABELS
+                   if any(columns and label in columns
+                          for _, columns in micColumns)]
+
+    for mic, columns in micColumns:
+        if not columns:
+            continue
+
+        coord = Coordinate()
+        extraAttrs = {}
+        for label, AttrClass in extraLabels:
+            extraAttrs[label] = AttrClass()
+            setattr(coord, '_' + label, extraAttrs[label])
+
+        for i, (x, y) in enumerate(zip(columns['rlnCoordinateX'],
+                                       columns['rlnCoordinateY'])):
+            coord.setObjId(None)
+            coord.setPosition(x, y)
+            coord.setMicrograph(mic)
+            for label, attr in extraAttrs.items():
+                attr.set(columns[label][i] if label in columns else None)
+            if postprocessCoord is not None:
+                postprocessCoord(coord)
+            coordSet.append(coord)
+
+
+def removeNearDuplicates(positions, scores, minDistance):
+    """ Return a boolean mask with the positions to keep, so no two kept
+    positions are closer than minDistance. Positions are visited from the
+    highest to the lowest score (keeping the input order for equal scores)
+    and discarded if they are too close to an already kept one.
+
+    Params:
+        positions: (N, 2) array with the x, y positions.
+        scores: (N,) array with the score of each position.
+        minDistance: minimum distance between kept positions.
+    """
+    n = len(positions)
+    keep = np.ones(n, dtype=bool)
+    if n < 2 or minDistance <= 0:
+        return keep
+
+    order = np.argsort(-np.asarray(scores, dtype=float), kind='stable')
+    pos = np.asarray(positions, dtype=float)[order]
+
+    # Hash the positions in a grid with cells of minDistance size, so
+    # close positions can only be in the same or in a neighbour cell
+    cells = np.floor(pos / minDistance).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    width = cells[:, 1].max() + 2
+    keys = cells[:, 0] * width + cells[:, 1]
+    sortedIdx = np.argsort(keys, kind='stable')
+    sortedKeys = keys[sortedIdx]
+
+    first, second = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbourKeys = keys + dx * width + dy
+            lo = np.searchsorted(sortedKeys, neighbourKeys, side='left')
+            hi = np.searchsorted(sortedKeys, neighbourKeys, side='right')
+            counts = hi - lo
+            if not counts.any():
+                continue
+            i = np.repeat(np.arange(n), counts)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            j = sortedIdx[np.repeat(lo, counts) + offsets]
+            first.append(i)
+            second.append(j)
+
+    i = np.concatenate(first)
+    j = np.concatenate(second)
+    # Only pairs of close positions, with i better ranked than j
+    close = (i < j) & (np.sum((pos[i] - pos[j]) ** 2, axis=1)
+                       < minDistance ** 2)
+    i, j = i[close], j[close]
+
+    # Resolve the (usually few) conflicts in rank order, a position can
+    # only remove others if it has not been removed by a better one
+    keepSorted = np.ones(n, dtype=bool)
+    for a, b in sorted(zip(i.tolist(), j.tolist())):
+        if keepSorted[a]:
+            keepSorted[b] = False
+
+    keep[order] = keepSorted
+    return keep
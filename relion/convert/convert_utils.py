@@ -31,7 +31,9 @@ newer Relion3.1 routines and old ones.
 """
 
 import os
+import json
 import math
+import numpy as np
 from emtable import Table
 import logging
 logger = logging.getLogger(__name__)
@@ -253,3 +255,27 @@ def getVolumesFromPostprocess(postStar):
     return (row.rlnUnfilteredMapHalf1,
             row.rlnUnfilteredMapHalf2,
             row.rlnMaskName)
+
+
+def writeMotionModel(filename, coeffs, hotPixels):
+    """ Store the local motion coefficients and hot pixels of a movie
+    in a .npz file, to avoid keeping long lists in the movie rows.
+    """
+    np.savez(filename,
+             coeffs=np.asarray(coeffs, dtype=float),
+             hotPixels=np.asarray(hotPixels, dtype=int).reshape(-1, 2))
+    return filename
+
+
+def readMotionModel(movie):
+    """ Return the local motion coefficients and hot pixels of a movie
+    as lists. They are read from the file written by writeMotionModel,
+    or from the json attributes used by older motion correction runs.
+    """
+    motionFn = movie.getAttributeValue('_rlnMotionModelFile', None)
+    if motionFn:
+        with np.load(motionFn) as data:
+            return data['coeffs'].tolist(), data['hotPixels'].tolist()
+
+    return (json.loads(movie.getAttributeValue('_rlnMotionModelCoeff', '[]')),
+            json.loads(movie.getAttributeValue('_rlnHotPixels', '[]')))
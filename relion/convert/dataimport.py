@@ -32,7 +32,7 @@ logger = logging.getLogger(__name__)
 
 from pyworkflow.object import Float
 from pwem.constants import ALIGN_PROJ, ALIGN_2D, ALIGN_NONE
-from pwem.objects import Micrograph, Coordinate
+from pwem.objects import Micrograph
 import pyworkflow.utils as pwutils
 
 from relion import convert
@@ -431,18 +431,17 @@ class RelionImport:
                     postprocessCoordRow=self._postprocessCoordRow)
                 break
         else:  # multiple star files with coords
+            micList, coordFiles = [], []
             for coordFile, fileId in prot.iterFiles():
                 mic = prot.getMatchingMic(coordFile, fileId)
                 if mic is not None:
-                    # Parse the coordinates in the given format for this micrograph
-                    coord = Coordinate()
-                    for row in Table(fileName=coordFile):
-                        coord.setObjId(None)
-                        coord.setPosition(row.rlnCoordinateX,
-                                          row.rlnCoordinateY)
-                        coord.setMicrograph(mic)
-                        self._postprocessCoordRow(coord, row)
-                        coordsSet.append(coord)
+                    micList.append(mic.clone())
+                    coordFiles.append(coordFile)
+            # Parse all files at once in the given format for each micrograph
+            convert.readCoordinateFiles(
+                coordsSet, micList, coordFiles,
+                numberOfThreads=prot.numberOfThreads.get(),
+                postprocessCoord=prot.correctCoordinatePosition)
 
         return coordsSet
 
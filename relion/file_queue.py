@@ -0,0 +1,292 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Simple work queue on a shared filesystem, used by streaming protocols to
+run their batches on several nodes without any external broker.
+
+Tasks are json files moved between the 'pending', 'claimed' and 'done'
+folders of the queue with atomic renames, so only one worker can claim
+a given task. While a task runs, its worker touches the claimed file as a
+heartbeat; claims not touched for longer than the lease timeout (e.g. the
+worker died) are moved back to pending. Workers can be started on any node
+that sees the queue folder (and the batch folders) with:
+
+    scipion python -m relion.file_queue <queue_folder> [--threads N]
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+import logging
+logger = logging.getLogger(__name__)
+
+
+class FileQueue:
+    """ Queue of tasks stored as files inside a shared folder. """
+    PENDING = 'pending'
+    CLAIMED = 'claimed'
+    DONE = 'done'
+    STOP = 'STOP'
+
+    def __init__(self, path, leaseTimeout=300, maxAttempts=3):
+        """
+        Params:
+            path: shared folder of the queue.
+            leaseTimeout: seconds after which a claimed task without
+                heartbeat is considered lost and queued again.
+            maxAttempts: number of times a task is claimed before it is
+                considered failed.
+        """
+        self.path = path
+        self.leaseTimeout = leaseTimeout
+        self.maxAttempts = maxAttempts
+
+    def create(self):
+        """ Create the queue folders, removing the tasks and results
+        left by a previous run. """
+        for folder in [self.PENDING, self.CLAIMED, self.DONE]:
+            folderPath = self._getFn(folder)
+            os.makedirs(folderPath, exist_ok=True)
+            for name in os.listdir(folderPath):
+                self._remove(os.path.join(folderPath, name))
+        self._remove(self._getFn(self.STOP))
+
+    def _getFn(self, *paths):
+        return os.path.join(self.path, *paths)
+
+    def _getTaskFn(self, folder, taskId):
+        return self._getFn(folder, '%s.json' % taskId)
+
+    @staticmethod
+    def _remove(fn):
+        """ Remove the file, return False if it did not exist. """
+        try:
+            os.remove(fn)
+            return True
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _readJson(fn):
+        with open(fn) as f:
+            return json.load(f)
+
+    def _writeJson(self, fn, data):
+        """ Write the file with a temporary name and rename it,
+        so readers never see an incomplete file. """
+        folder, name = os.path.split(fn)
+        tmpFn = os.path.join(folder, '.%s.tmp' % name)
+        with open(tmpFn, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmpFn, fn)
+
+    # ---------------------- Functions used by the protocol ------------------
+    def submit(self, taskId, program, args, cwd):
+        """ Add a new task to run program with args from the cwd folder. """
+        task = {'id': taskId, 'program': program, 'args': args,
+                'cwd': os.path.abspath(cwd), 'attempts': 0}
+        self._writeJson(self._getTaskFn(self.PENDING, taskId), task)
+
+    def result(self, taskId):
+        """ Return the result of the task, or None if it is not done. """
+        try:
+            return self._readJson(self._getTaskFn(self.DONE, taskId))
+        except FileNotFoundError:
+            return None
+
+    def wait(self, taskId, sleep=5, timeout=None):
+        """ Wait until the task is done and return its result. Lost claims
+        are queued again while waiting. If timeout (seconds) is reached,
+        the task is removed from the queue and TimeoutError is raised. """
+        t0 = time.time()
+        while (result := self.result(taskId)) is None:
+            if timeout is not None and time.time() - t0 > timeout:
+                self.cancel(taskId)
+                raise TimeoutError("Task %s was not done after %d seconds"
+                                   % (taskId, timeout))
+            self.requeueExpired()
+            time.sleep(sleep)
+        self._remove(self._getTaskFn(self.DONE, taskId))
+        return result
+
+    def cancel(self, taskId):
+        """ Remove the task from the queue. A worker already running it
+        will still complete it, but its result is discarded. """
+        for folder in [self.PENDING, self.CLAIMED, self.DONE]:
+            self._remove(self._getTaskFn(folder, taskId))
+
+    def requeueExpired(self):
+        """ Move back to pending the claimed tasks whose worker has not
+        sent a heartbeat within the lease timeout. Tasks claimed too many
+        times are completed with an error instead. Return the number of
+        requeued tasks. """
+        claimedDir = self._getFn(self.CLAIMED)
+        now = time.time()
+        count = 0
+        for name in os.listdir(claimedDir):
+            if name.startswith('.') or not name.endswith('.json'):
+                continue
+            claimedFn = os.path.join(claimedDir, name)
+            try:
+                if now - os.path.getmtime(claimedFn) < self.leaseTimeout:
+                    continue
+                # Only one process can win this rename
+                expiredFn = os.path.join(claimedDir, '.%s.expired' % name)
+                os.rename(claimedFn, expiredFn)
+            except FileNotFoundError:  # completed or requeued meanwhile
+                continue
+
+            task = self._readJson(expiredFn)
+            if task.get('attempts', 1) >= self.maxAttempts:
+                logger.error("Task %s lost %d times, giving up.",
+                             task['id'], task['attempts'])
+                result = dict(task, returnCode=-1, elapsed=0, host=None)
+                self._writeJson(self._getFn(self.DONE, name), result)
+            else:
+                logger.warning("Task %s lost, queued again.", task['id'])
+                self._writeJson(self._getFn(self.PENDING, name), task)
+                count += 1
+            os.remove(expiredFn)
+        return count
+
+    def stop(self):
+        """ Notify workers to exit once there are no pending tasks. """
+        open(self._getFn(self.STOP), 'w').close()
+
+    # ---------------------- Functions used by the workers -------------------
+    def claim(self):
+        """ Take the first pending task, or return None if there is none. """
+        pendingDir = self._getFn(self.PENDING)
+        for name in sorted(os.listdir(pendingDir)):
+            if name.startswith('.') or not name.endswith('.json'):
+                continue
+            claimedFn = self._getFn(self.CLAIMED, name)
+            try:
+                os.rename(os.path.join(pendingDir, name), claimedFn)
+                # The rename keeps the submission time, start the lease now
+                os.utime(claimedFn)
+                task = self._readJson(claimedFn)
+            except FileNotFoundError:  # claimed or requeued by another one
+                continue
+            task['attempts'] = task.get('attempts', 0) + 1
+            self._writeJson(claimedFn, task)
+            return task
+        return None
+
+    def heartbeat(self, task):
+        """ Renew the lease of a claimed task.
+        Return False if the task is no longer claimed by this worker. """
+        try:
+            os.utime(self._getTaskFn(self.CLAIMED, task['id']))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, task, returnCode, elapsed):
+        """ Store the result of a claimed task. """
+        # If the claim was lost, the task has been queued again (or
+        # cancelled) and this result is discarded
+        if not self._remove(self._getTaskFn(self.CLAIMED, task['id'])):
+            logger.warning("Claim of task %s was lost, result discarded.",
+                           task['id'])
+            return
+        result = dict(task, returnCode=returnCode, elapsed=elapsed,
+                      host=socket.gethostname())
+        self._writeJson(self._getTaskFn(self.DONE, task['id']), result)
+
+    def isStopped(self):
+        return os.path.exists(self._getFn(self.STOP))
+
+    def runTask(self, task, env=None):
+        """ Run the task command, writing its output to a log file
+        in the task folder. """
+        t0 = time.time()
+        logFn = os.path.join(task['cwd'], '%s.log' % task['program'])
+        # Renew the lease a few times within the timeout
+        heartbeatSecs = max(1, self.leaseTimeout / 4)
+        try:
+            with open(logFn, 'a') as log:
+                p = subprocess.Popen('%s %s' % (task['program'], task['args']),
+                                     shell=True, cwd=task['cwd'], env=env,
+                                     stdout=log, stderr=subprocess.STDOUT)
+                while True:
+                    try:
+                        returnCode = p.wait(timeout=heartbeatSecs)
+                        break
+                    except subprocess.TimeoutExpired:
+                        self.heartbeat(task)
+        except OSError as e:
+            logger.error("Task %s could not be run: %s", task['id'], e)
+            returnCode = -1
+        self.complete(task, returnCode, time.time() - t0)
+
+    def work(self, env=None, sleep=5):
+        """ Claim and run tasks until the queue is stopped and empty. """
+        while True:
+            self.requeueExpired()
+            task = self.claim()
+            if task is not None:
+                self.runTask(task, env=env)
+            elif self.isStopped():
+                break
+            else:
+                time.sleep(sleep)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the tasks of a shared folder queue.")
+    parser.add_argument('path', help="Queue folder.")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="Number of tasks to run at the same time.")
+    parser.add_argument('--sleep', type=int, default=5,
+                        help="Seconds to wait when there are no tasks.")
+    parser.add_argument('--lease', type=int, default=300,
+                        help="Seconds without heartbeat after which a "
+                             "claimed task is queued again.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s: %(message)s')
+
+    from relion import Plugin
+    env = Plugin.getEnviron()
+    queue = FileQueue(args.path, leaseTimeout=args.lease)
+
+    threads = [threading.Thread(target=queue.work,
+                                kwargs={'env': env, 'sleep': args.sleep})
+               for _ in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
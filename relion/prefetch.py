@@ -0,0 +1,119 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Read-ahead of input files, so reading the next movies from slow storage
+overlaps with the processing of the current ones.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+
+GB = 1024 ** 3
+
+
+class FilePrefetcher:
+    """ Warm the page cache for files that will be read soon.
+
+    Files are prefetched in a background thread in the order they are
+    added. The total size of the prefetched files that have not been
+    released yet is kept below maxBytes, so the look-ahead does not
+    evict the files that are being processed.
+    """
+    CHUNK = 16 * 1024 * 1024
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self._pending = OrderedDict()
+        self._fetched = {}
+        self._usedBytes = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, filenames):
+        """ Add files to be prefetched after the ones already added. """
+        with self._cond:
+            for fn in filenames:
+                if fn and fn not in self._fetched:
+                    self._pending[fn] = True
+            self._cond.notify()
+
+    def release(self, filenames):
+        """ Notify that these files have been read, so their size
+        does not count anymore for the budget. """
+        with self._cond:
+            for fn in filenames:
+                self._pending.pop(fn, None)
+                self._usedBytes -= self._fetched.pop(fn, 0)
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _next(self):
+        """ Wait until there is a file that fits in the budget. """
+        with self._cond:
+            while not self._stopped:
+                if self._pending:
+                    fn = next(iter(self._pending))
+                    size = _getSize(fn)
+                    # Always allow one file, even if bigger than the budget
+                    if not self._fetched or self._usedBytes + size <= self.maxBytes:
+                        del self._pending[fn]
+                        self._fetched[fn] = size
+                        self._usedBytes += size
+                        return fn
+                self._cond.wait()
+        return None
+
+    def _run(self):
+        while (fn := self._next()) is not None:
+            try:
+                prefetchFile(fn, self.CHUNK)
+            except OSError:
+                pass  # Prefetch is only a hint, the file will be read anyway
+
+
+def _getSize(fn):
+    try:
+        return os.path.getsize(fn)
+    except OSError:
+        return 0
+
+
+def prefetchFile(fn, chunkSize=FilePrefetcher.CHUNK):
+    """ Ask the kernel to read ahead the file and read it through, since
+    the advice is ignored by some network filesystems. """
+    with open(fn, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        buffer = bytearray(chunkSize)
+        while f.readinto(buffer):
+            pass
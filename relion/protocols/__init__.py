@@ -46,12 +46,14 @@ from .protocol_extract_particles import ProtRelionExtractParticles
 from .protocol_gentle_clean import ProtRelionCleanJobs
 from .protocol_initialmodel import ProtRelionInitialModel
 from .protocol_localres import ProtRelionLocalRes
+from .protocol_merge_coordinates import ProtRelionMergeCoordinates
 from .protocol_motioncor import ProtRelionMotioncor
 from .protocol_multibody import ProtRelionMultiBody
 from .protocol_postprocess import ProtRelionPostprocess
 from .protocol_preprocess import ProtRelionPreprocessParticles
 from .protocol_reconstruct import ProtRelionReconstruct
 from .protocol_refine3d import ProtRelionRefine3D
+from .protocol_remove_duplicates import ProtRelionRemoveDuplicates
 from .protocol_remove_views import ProtRelionRemovePrefViews
 from .protocol_select_classes import ProtRelionSelectClasses2D
 from .protocol_subtract import ProtRelionSubtract
@@ -25,6 +25,7 @@
 # **************************************************************************
 
 import os
+import sqlite3
 import emtable
 
 from pyworkflow.object import Integer
@@ -170,6 +171,7 @@ class ProtRelionAssignOpticsGroup(ProtRelionBase):
         inputSet = self.inputSet.get()
 
         getMicName = lambda item: item.getMicName()
+        micNameLabel = '_micName'
 
         if isinstance(inputSet, SetOfMovies):
             outputSet = self._createSetOfMovies()
@@ -181,6 +183,7 @@ class ProtRelionAssignOpticsGroup(ProtRelionBase):
             outputSet = self._createSetOfParticles()
             outputName = 'outputParticles'
             getMicName = lambda item: item.getCoordinate().getMicName()
+            micNameLabel = '_coordinate._micName'
         else:
             raise TypeError("Invalid input of type %s, expecting:\n"
                             "SetOfMovies, SetOfMicrographs or SetOfParticles"
@@ -245,6 +248,14 @@ class ProtRelionAssignOpticsGroup(ProtRelionBase):
                             i.rlnMicrographGainName, i.rlnOpticsGroupName
                         ))
 
+            if self._bulkAssignGroups(inputSet, outputSet,
+                                      micNameLabel, micDict):
+                self.info(og)
+                og.toImages(outputSet)
+                self._defineOutputs(**{outputName: outputSet})
+                self._defineTransformRelation(inputSet, outputSet)
+                return
+
             def updateItem(item, row):
                 micName = getMicName(item)
 
@@ -322,6 +333,74 @@ class ProtRelionAssignOpticsGroup(ProtRelionBase):
         return warnings
 
     # -------------------------- UTILS functions ------------------------------
+    def _bulkAssignGroups(self, inputSet, outputSet, micNameLabel, micDict):
+        """ Assign the optics group of all items directly in the database:
+        copy the input sqlite and update the _rlnOpticsGroup column with
+        a single statement joined with a micName -> group table.
+        Items whose micName is not in micDict are removed, as done when
+        copying the items one by one.
+        Return False if the input database does not have the expected
+        layout, so the items should be copied one by one.
+        """
+        inputFn = inputSet.getFileName()
+        if not os.path.exists(inputFn) or (inputSet.getPrefix() or "").strip():
+            return False
+
+        outputFn = outputSet.getFileName()
+        outputSet.close()
+        pwutils.cleanPath(outputFn)
+        src = sqlite3.connect(inputFn)
+        db = sqlite3.connect(outputFn)
+        try:
+            src.backup(db)
+            src.close()
+            columns = dict(db.execute("SELECT label_property, column_name "
+                                      "FROM Classes"))
+            micCol = columns.get(micNameLabel)
+            if micCol is None:
+                db.close()
+                pwutils.cleanPath(outputFn)
+                return False
+
+            ogCol = columns.get('_rlnOpticsGroup')
+            if ogCol is None:
+                ogCol = 'c%02d' % (max(int(c[1:]) for c in columns.values()) + 1)
+                db.execute("ALTER TABLE Objects ADD COLUMN %s INTEGER "
+                           "DEFAULT NULL" % ogCol)
+                db.execute("INSERT INTO Classes (label_property, column_name, "
+                           "class_name) VALUES ('_rlnOpticsGroup', ?, "
+                           "'Integer')", (ogCol,))
+
+            db.execute("CREATE TEMP TABLE micGroups "
+                       "(micName TEXT PRIMARY KEY, opticsGroup INTEGER)")
+            db.executemany("INSERT INTO micGroups VALUES (?, ?)",
+                           micDict.items())
+
+            missing = db.execute(
+                "SELECT %(mic)s, COUNT(*) FROM Objects WHERE %(mic)s IS NULL "
+                "OR %(mic)s NOT IN (SELECT micName FROM micGroups) "
+                "GROUP BY %(mic)s" % {'mic': micCol}).fetchall()
+            for micName, count in missing:
+                self.warning("Micrograph name (aka micName) '%s' was "
+                             "not found in the 'data_micrographs' table of "
+                             "the input star file: %s (%d items skipped)"
+                             % (micName, self.inputStar.get(), count))
+
+            db.execute("DELETE FROM Objects WHERE %(mic)s IS NULL OR %(mic)s "
+                       "NOT IN (SELECT micName FROM micGroups)"
+                       % {'mic': micCol})
+            db.execute("UPDATE Objects SET %s = (SELECT opticsGroup FROM "
+                       "micGroups WHERE micGroups.micName = Objects.%s)"
+                       % (ogCol, micCol))
+            size = db.execute("SELECT COUNT(*) FROM Objects").fetchone()[0]
+            db.commit()
+        finally:
+            db.close()
+
+        # The items are loaded from the updated database on demand
+        outputSet._size.set(size)
+        return True
+
     def _convertGain(self):
         """ We need to transform gain file for a possible polishing job. """
         rotation = self.gainRot.get()
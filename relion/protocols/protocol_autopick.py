@@ -25,6 +25,8 @@
 # **************************************************************************
 
 import os
+from math import ceil
+from concurrent.futures import ThreadPoolExecutor
 
 import pyworkflow.utils as pwutils
 from pwem.protocols import ProtParticlePickingAuto
@@ -38,6 +40,19 @@ class ProtRelionAutopickBase(ProtParticlePickingAuto, ProtRelionBase):
     """
     _label = None
 
+    def _insertPickMicrographListStep(self, micList, prerequisites, *args):
+        """ Store the list of micrograph names by reference, since it
+        can contain all input micrographs if not working in streaming.
+        """
+        micNames = self._storeStepArg([mic.getMicName() for mic in micList])
+        return self._insertFunctionStep('pickMicrographListStep',
+                                        micNames, *args,
+                                        prerequisites=prerequisites)
+
+    def pickMicrographListStep(self, micNameList, *args):
+        ProtParticlePickingAuto.pickMicrographListStep(
+            self, self._loadStepArg(micNameList), *args)
+
     def _pickMicrograph(self, mic, *args):
         """ This method should be invoked only when working in streaming mode.
         """
@@ -47,14 +62,61 @@ class ProtRelionAutopickBase(ProtParticlePickingAuto, ProtRelionBase):
         if not micList:
             return
 
+        # Never run more jobs than MPI processes, each one needs at least one
+        numberOfMpi = self.numberOfMpi.get()
+        shards = self._getPickShards()[:min(len(micList), numberOfMpi)]
+        if len(shards) <= 1:
+            self._pickShard(micList, None, self.numberOfMpi.get(), *args)
+            return
+
+        # Split the micrographs in groups picked concurrently, one per GPU
+        # (or CPU group), each one in its own temporary folder
+        shardSize = ceil(len(micList) / len(shards))
+        micLists = [micList[i:i + shardSize]
+                    for i in range(0, len(micList), shardSize)]
+        # Divide the MPI processes among the groups, the first ones
+        # take the remaining processes
+        mpis = [numberOfMpi // len(micLists) +
+                (1 if i < numberOfMpi % len(micLists) else 0)
+                for i in range(len(micLists))]
+        self.info("Picking %d micrographs in %d groups"
+                  % (len(micList), len(micLists)))
+
+        with ThreadPoolExecutor(max_workers=len(micLists)) as executor:
+            futures = [executor.submit(self._pickShard, shardMics, gpu, mpi,
+                                       *args)
+                       for shardMics, gpu, mpi in zip(micLists, shards, mpis)]
+            for future in futures:
+                future.result()  # Raise any error of the picking jobs
+
+    def _pickShard(self, micList, gpu, numberOfMpi, *args):
+        """ Run relion_autopick for this list of micrographs. """
         micsDir = self._createTmpMicsDir(micList)
         micStar = os.path.join(micsDir, 'input_micrographs.star')
         writer = convert.createWriter(rootDir=micsDir, outputDir=micsDir)
         writer.writeSetOfMicrographs(micList, micStar)
-        self._pickMicrographsFromStar(micStar, micsDir, *args)
+        shardArgs = {'numberOfMpi': numberOfMpi}
+        if gpu is not None:
+            shardArgs['gpu'] = gpu
+        self._pickMicrographsFromStar(micStar, micsDir, *args, **shardArgs)
         # Move coordinates files to tmp
         os.system('mv %s/*autopick.star %s/' % (micsDir, self._getTmpPath()))
 
+    def _getPickShards(self):
+        """ Return the GPU used by each of the concurrent autopick jobs,
+        or None for the jobs running on CPU. """
+        if self.usesGpu():
+            gpuList = self.getGpuList()
+            if gpuList:
+                return [str(gpu) for gpu in gpuList]
+        return [None] * max(1, self.getAttributeValue('numberOfShards', 1))
+
+    def _runAutopick(self, params, cwd, numberOfMpi=None):
+        if numberOfMpi is None:
+            numberOfMpi = self.numberOfMpi.get()
+        program = 'relion_autopick' + ('_mpi' if numberOfMpi > 1 else '')
+        self.runJob(program, params, cwd=cwd, numberOfMpi=numberOfMpi)
+
     def _createSetOfCoordinates(self, micSet, suffix=''):
         """ Override this method to set the box size. """
         coordSet = ProtParticlePickingAuto._createSetOfCoordinates(
@@ -67,7 +129,8 @@ class ProtRelionAutopickBase(ProtParticlePickingAuto, ProtRelionBase):
         """
         template = self._getTmpPath("mic_%06d_autopick.star")
         starFiles = [template % mic.getObjId() for mic in micList]
-        convert.readSetOfCoordinates(coordSet, starFiles, micList)
+        convert.readCoordinateFiles(coordSet, micList, starFiles,
+                                    numberOfThreads=self.numberOfThreads.get())
 
     def _pickMicrographsFromStar(self, micStar, micsDir, *args):
         """ Should be defined in subclasses. """
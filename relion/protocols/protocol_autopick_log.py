@@ -24,14 +24,22 @@
 # *
 # **************************************************************************
 
+import os
+import random
 from os.path import relpath
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from emtable import Table
 
 import pyworkflow.protocol.params as params
+import pyworkflow.utils as pwutils
 from pyworkflow.utils.properties import Message
 from pyworkflow.constants import PROD
 from pyworkflow.protocol import STEPS_SERIAL
 from pwem.protocols import ProtParticlePickingAuto
 
+import relion.convert as convert
 from .protocol_autopick import ProtRelionAutopickBase
 
 
@@ -113,11 +121,128 @@ class ProtRelionAutopickLoG(ProtRelionAutopickBase):
                            'The command "relion_autopick" will print a list '
                            'of possible options.')
 
+        form.addSection(label='Preview')
+        form.addParam('doPreview', params.BooleanParam, default=False,
+                      label='Only preview thresholds?',
+                      help='If set to Yes, the micrographs will not be '
+                           'picked. Instead, a random sample of micrographs '
+                           'is picked with each of the thresholds given '
+                           'below and the number of picks per micrograph '
+                           'and the distribution of the figure-of-merit are '
+                           'reported for each value. This allows to choose '
+                           'the threshold in a few minutes before picking '
+                           'the whole dataset.')
+        form.addParam('previewSize', params.IntParam, default=10,
+                      condition='doPreview',
+                      validators=[params.Positive],
+                      label='Number of micrographs',
+                      help='Number of randomly selected micrographs to '
+                           'pick for each threshold.')
+        form.addParam('previewThresholds', params.StringParam,
+                      default='-1 -0.5 0 0.5 1',
+                      condition='doPreview',
+                      label='Thresholds to try (stddev)',
+                      help='List of values of the *Adjust default threshold* '
+                           'parameter to try, separated by spaces. The other '
+                           'parameters are the ones from the Input tab. '
+                           'Up to the number of MPI processes are picked '
+                           'at the same time.')
+
         self._defineStreamingParams(form)
 
+        form.addParam('numberOfShards', params.IntParam, default=1,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Number of picking groups',
+                      help='Split the micrographs of each step into this '
+                           'number of groups, that are picked by independent '
+                           'relion_autopick jobs running at the same time. '
+                           'The MPI processes are divided among the groups, '
+                           'so there are at most as many groups as MPI '
+                           'processes.')
+
         form.addParallelSection(threads=0, mpi=4)
 
+    # -------------------------- INSERT steps functions -----------------------
+    def _insertAllSteps(self):
+        if self.doPreview:
+            self._insertFunctionStep(self.previewStep, *self._getPickArgs())
+            # Disable streaming functions
+            self._stepsCheck = self._doNothing
+        else:
+            ProtRelionAutopickBase._insertAllSteps(self)
+
+    def _doNothing(self, *args):
+        pass
+
     # -------------------------- STEPS functions ------------------------------
+    def previewStep(self, params, minDiameter, maxDiameter,
+                    threshold, threshold2):
+        """ Pick a sample of the micrographs with each of the thresholds
+        and store the number of picks and FOM distribution of each one. """
+        inputMics = self.getInputMicrographs()
+        micIds = set(random.sample(sorted(inputMics.getIdSet()),
+                                   min(self.previewSize.get(),
+                                       inputMics.getSize())))
+        micList = [mic.clone() for mic in inputMics.iterItems()
+                   if mic.getObjId() in micIds]
+        thresholds = self._getPreviewThresholds()
+
+        def _pick(i):
+            micsDir = self._getExtraPath('preview_%02d' % i)
+            pwutils.makePath(micsDir)
+            micStar = os.path.join(micsDir, 'input_micrographs.star')
+            writer = convert.createWriter(rootDir=micsDir, outputDir=micsDir)
+            writer.writeSetOfMicrographs(micList, micStar)
+            self._pickMicrographsFromStar(micStar, micsDir, params,
+                                          minDiameter, maxDiameter,
+                                          thresholds[i], threshold2,
+                                          numberOfMpi=1)
+            return self._readPreviewFoms(micsDir, micList)
+
+        workers = max(1, min(self.numberOfMpi.get(), len(thresholds)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_pick, range(len(thresholds))))
+
+        table = Table(columns=['threshold', 'micrographs', 'particles',
+                               'minPerMic', 'maxPerMic', 'meanFom'])
+        for t, (counts, foms) in zip(thresholds, results):
+            table.addRow(t, len(counts), int(sum(counts)), int(min(counts)),
+                         int(max(counts)), float(np.mean(foms)) if foms else 0.)
+        table.write(self._getPreviewStar(), tableName='preview')
+        self._plotPreviewFoms(thresholds, [foms for _, foms in results])
+
+    def _readPreviewFoms(self, micsDir, micList):
+        """ Return the number of picks of each micrograph and the
+        FOM of all picks in this preview folder. """
+        counts, foms = [], []
+        for mic in micList:
+            starFn = os.path.join(micsDir, 'mic_%06d_autopick.star'
+                                  % mic.getObjId())
+            if not os.path.exists(starFn):  # No picks
+                counts.append(0)
+                continue
+            table = Table(fileName=starFn)
+            counts.append(len(table))
+            if table.hasColumn('rlnAutopickFigureOfMerit'):
+                foms.extend(table.getColumnValues('rlnAutopickFigureOfMerit'))
+        return counts, foms
+
+    def _plotPreviewFoms(self, thresholds, fomsList):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        figure = Figure(figsize=(6, 4))
+        FigureCanvasAgg(figure)
+        ax = figure.add_subplot(111)
+        for t, foms in zip(thresholds, fomsList):
+            if foms:
+                ax.hist(foms, bins=50, histtype='step',
+                        label='threshold %0.2f (%d)' % (t, len(foms)))
+        ax.set_xlabel('Figure-of-merit')
+        ax.set_ylabel('Particles')
+        ax.legend(fontsize='small')
+        figure.tight_layout()
+        figure.savefig(self._getExtraPath('preview_fom.png'))
 
     def getAutopickParams(self):
         """ Return the autopicking parameters except for the interactive ones. """
@@ -144,7 +269,8 @@ class ProtRelionAutopickLoG(ProtRelionAutopickBase):
         return args
 
     def _pickMicrographsFromStar(self, micStarFile, cwd, params,
-                                 minDiameter, maxDiameter, threshold, threshold2):
+                                 minDiameter, maxDiameter, threshold, threshold2,
+                                 numberOfMpi=None):
         """ Launch the 'relion_autopick' for micrographs in the inputStarFile.
          If the input set of complete, the star file will contain all the
          micrographs. If working in streaming, it will be only one micrograph.
@@ -155,18 +281,40 @@ class ProtRelionAutopickLoG(ProtRelionAutopickBase):
         params += ' --LoG_adjust_threshold %0.3f' % threshold
         params += ' --LoG_upper_threshold %0.3f' % threshold2
 
-        program = self._getProgram('relion_autopick')
-
-        self.runJob(program, params, cwd=cwd)
+        self._runAutopick(params, cwd, numberOfMpi)
 
     # -------------------------- INFO functions --------------------------------
     def _validate(self):
         errors = []
+        if self.doPreview:
+            try:
+                if not self._getPreviewThresholds():
+                    errors.append("Provide at least one threshold to "
+                                  "preview.")
+            except ValueError:
+                errors.append("Invalid list of thresholds to preview: %s"
+                              % self.previewThresholds.get())
         return errors
 
     def _summary(self):
         summary = []
 
+        if self.doPreview:
+            summary.append("Threshold preview on *%d* micrographs."
+                           % self.previewSize)
+            if os.path.exists(self._getPreviewStar()):
+                for row in Table(fileName=self._getPreviewStar(),
+                                 tableName='preview'):
+                    summary.append(
+                        "Threshold %0.2f: %d particles, %0.1f per "
+                        "micrograph (%d - %d), mean FOM %0.3f"
+                        % (row.threshold, row.particles,
+                           row.particles / max(1, row.micrographs),
+                           row.minPerMic, row.maxPerMic, row.meanFom))
+                summary.append("FOM histograms: %s"
+                               % self._getExtraPath('preview_fom.png'))
+            return summary
+
         if self.getInputMicrographs() is not None:
             summary.append("Using Relion LoG picker.")
             summary.append("Number of input micrographs: *%d*"
@@ -184,3 +332,9 @@ class ProtRelionAutopickLoG(ProtRelionAutopickBase):
     def getBoxSize(self):
         """ Return a reasonable box-size in pixels. """
         return self.boxSize.get()
+
+    def _getPreviewThresholds(self):
+        return [float(t) for t in self.previewThresholds.get().split()]
+
+    def _getPreviewStar(self):
+        return self._getExtraPath('preview.star')
@@ -24,12 +24,18 @@
 # *
 # **************************************************************************
 
+import os
+import math
+from collections import OrderedDict
 from os.path import relpath, abspath
 
+from emtable import Table
+
 import pyworkflow.protocol.params as params
 from pwem.protocols import ProtParticlePickingAuto
 from pwem.constants import RELATION_CTF
 from pwem.emlib.image import ImageHandler
+from pwem.objects import SetOfMicrographs, SetOfCTF
 from pyworkflow.utils.properties import Message
 import pyworkflow.utils as pwutils
 from pyworkflow.constants import PROD
@@ -39,6 +45,68 @@ from ..constants import REF_AVERAGES, REF_VOLUME, ANGULAR_SAMPLING_LIST
 from .protocol_autopick import ProtRelionAutopickBase
 
 
+def _parseSymmetry(symmetry):
+    """ Return the group letter and order of Cn and Dn symmetries,
+    or (None, None) for other point groups. """
+    sym = symmetry.strip().upper()
+    if sym[:1] in ('C', 'D') and sym[1:].isdigit() and int(sym[1:]) > 0:
+        return sym[0], int(sym[1:])
+    return None, None
+
+
+def isHealpixSymmetrySupported(symmetry):
+    """ Return True if getHealpixDirections can reduce the sampling to
+    the asymmetric unit of this symmetry (only Cn and Dn). """
+    return _parseSymmetry(symmetry)[0] is not None
+
+
+def getHealpixDirections(order, symmetry='c1'):
+    """ Return the (rot, tilt) angles in degrees of the HEALPix sampling
+    of the sphere (RING scheme) with the given order. Only the directions
+    in the asymmetric unit of the Cn or Dn symmetry are kept, other point
+    groups are not supported.
+    """
+    group, n = _parseSymmetry(symmetry)
+    if group is None:
+        raise ValueError("Symmetry %s is not supported, only Cn and Dn"
+                         % symmetry)
+
+    nside = 2 ** order
+    npix = 12 * nside * nside
+    ncap = 2 * nside * (nside - 1)
+    fact2 = 3. * nside * nside
+    directions = []
+
+    for ipix in range(npix):
+        if ipix < ncap:  # North polar cap
+            iring = (1 + math.isqrt(1 + 2 * ipix)) // 2
+            iphi = ipix + 1 - 2 * iring * (iring - 1)
+            z = 1 - iring * iring / fact2
+            phi = (iphi - 0.5) * math.pi / (2 * iring)
+        elif ipix < npix - ncap:  # Equatorial region
+            ip = ipix - ncap
+            iring = ip // (4 * nside) + nside
+            iphi = ip % (4 * nside) + 1
+            fodd = 1 if (iring + nside) % 2 else 0.5
+            z = (2 * nside - iring) / (1.5 * nside)
+            phi = (iphi - fodd) * math.pi / (2 * nside)
+        else:  # South polar cap
+            ip = npix - ipix
+            iring = (1 + math.isqrt(2 * ip - 1)) // 2
+            iphi = 4 * iring + 1 - (ip - 2 * iring * (iring - 1))
+            z = -1 + iring * iring / fact2
+            phi = (iphi - 0.5) * math.pi / (2 * iring)
+
+        directions.append((math.degrees(phi),
+                           math.degrees(math.acos(max(-1., min(1., z))))))
+
+    maxRot = 360. / n
+    directions = [(rot, tilt) for rot, tilt in directions
+                  if rot < maxRot and (group == 'C' or tilt <= 90)]
+
+    return directions
+
+
 class ProtRelion2Autopick(ProtRelionAutopickBase):
     """ This protocol runs Relion autopicking (version > 3.0).
 
@@ -237,7 +305,11 @@ class ProtRelion2Autopick(ProtRelionAutopickBase):
                             'allocation by providing a list of which GPUs '
                             '(0,1,2,3, etc) to use. MPI-processes are '
                             'separated by ":", threads by ",". '
-                            'For example: "0,0:1,1:0,0:1,1"')
+                            'For example: "0,0:1,1:0,0:1,1"\n'
+                            'When several GPUs are given, the micrographs '
+                            'are split in groups and one autopick job is '
+                            'run on each GPU at the same time, with the '
+                            'MPI processes divided among them.')
 
         form.addParam('extraParams', params.StringParam, default='',
                       label='Additional arguments:',
@@ -260,6 +332,11 @@ class ProtRelion2Autopick(ProtRelionAutopickBase):
             # If the input is in streaming, follow the base class policy
             # about inserting new steps and discovery new input/output
             self.createOutputStep = self._doNothing
+            # Project the 3D reference only once instead of in every batch,
+            # other point groups than Cn and Dn are left to relion_autopick
+            self._projectRefs = (not self.useInputReferences() and
+                                 isHealpixSymmetrySupported(
+                                     self.symmetryGroup.get()))
             ProtParticlePickingAuto._insertAllSteps(self)
         else:
             # If not in streaming, then we will just insert a single step to
@@ -271,7 +348,8 @@ class ProtRelion2Autopick(ProtRelionAutopickBase):
                                      self.getInputMicrographs().strId(),
                                      self.getInputReferences().strId())
             nameList = [mic.getMicName() for mic in self.getInputMicrographs()]
-            self._insertFunctionStep(self.pickMicrographListStep, nameList,
+            self._insertFunctionStep(self.pickMicrographListStep,
+                                     self._storeStepArg(nameList),
                                      *self._getPickArgs())
             self._insertFunctionStep(self.createOutputStep)
 
@@ -295,23 +373,67 @@ class ProtRelion2Autopick(ProtRelionAutopickBase):
         """ This function is re-implemented in this protocol, because it have
          a SetOfCTF as input, so for streaming, we only want to report those
          micrographs for which the CTF is ready.
+         Only the items added since the last call are read from the input
+         sets, the micrographs (and CTFs) that are still waiting for their
+         pair are kept between calls.
         """
-        micDict, micClose = self._loadMics(self.getInputMicrographs())
-        ctfDict, ctfClosed = self._loadCTFs(self.ctfRelations.get())
+        if not hasattr(self, '_waitingMics'):
+            self._waitingMics = OrderedDict()
+            self._waitingCtfs = {}
+            self._inputIndex = {}
+
+        micDict, micClose = self._loadNewItems(
+            self.getInputMicrographs(), SetOfMicrographs,
+            lambda mic: mic.getMicName())
+        ctfDict, ctfClosed = self._loadNewItems(
+            self.ctfRelations.get(), SetOfCTF,
+            lambda ctf: ctf.getMicrograph().getMicName())
+        self._waitingMics.update(micDict)
+        self._waitingCtfs.update(ctfDict)
 
         # Keep the micrographs that have CTF
         # and set the CTF property for those who have it
         readyMics = dict()
 
-        for micKey, mic in micDict.items():
-            if micKey in ctfDict:
-
-                mic.setCTF(ctfDict[micKey])
+        for micKey in list(self._waitingMics):
+            if micKey in self._waitingCtfs:
+                mic = self._waitingMics.pop(micKey)
+                mic.setCTF(self._waitingCtfs.pop(micKey))
                 readyMics[micKey] = mic
 
         # Return the updated micDict and the closed status
         return readyMics, micClose and ctfClosed
 
+    def _loadNewItems(self, inputSet, SetClass, getKeyFunc):
+        """ Load the items of the input set with an id greater than the
+        last one loaded, the set is not opened if it has not been modified.
+        """
+        setFn = inputSet.getFileName()
+        index = self._inputIndex.setdefault(setFn, {'lastId': 0,
+                                                    'mTime': None,
+                                                    'closed': False})
+        mTime = os.stat(setFn).st_mtime_ns
+        newItemDict = OrderedDict()
+
+        if mTime == index['mTime']:
+            return newItemDict, index['closed']
+
+        self.debug("Loading input db: %s (id > %d)" % (setFn, index['lastId']))
+        updatedSet = SetClass(filename=setFn)
+        updatedSet.loadAllProperties()
+        micDict = getattr(self, 'micDict', {})
+        for item in updatedSet.iterItems(where='id > %d' % index['lastId']):
+            micKey = getKeyFunc(item)
+            if micKey not in micDict:
+                newItemDict[micKey] = item.clone()
+            index['lastId'] = max(index['lastId'], item.getObjId())
+        index['closed'] = updatedSet.isStreamClosed()
+        index['mTime'] = mTime
+        updatedSet.close()
+        self.debug("Closed db.")
+
+        return newItemDict, index['closed']
+
     # -------------------------- STEPS functions ------------------------------
     def convertInputStep(self, micsId, refsId):
         pwutils.makePath(self._getExtraPath('DONE'))  # Required to report finished
@@ -324,6 +446,42 @@ class ProtRelion2Autopick(ProtRelionAutopickBase):
                 ih.convert(avg, newAvgLoc)
         else:
             ih.convert(inputRefs, self._getPath('reference_3d.mrc'))
+            if self._useRefProjections():
+                self._projectReference()
+
+    def _projectReference(self):
+        """ Generate the 2D projections of the 3D reference for the same
+        directions that relion_autopick would use. """
+        inputRefs = self.getInputReferences()
+        order = int(self.angularSamplingDeg.get()) + 1
+        directions = getHealpixDirections(order, self.symmetryGroup.get())
+        self.info("Projecting 3D reference in %d directions" % len(directions))
+
+        opticsTable = Table(columns=['rlnOpticsGroup', 'rlnOpticsGroupName',
+                                     'rlnImagePixelSize', 'rlnImageSize',
+                                     'rlnImageDimensionality', 'rlnVoltage',
+                                     'rlnSphericalAberration',
+                                     'rlnAmplitudeContrast'])
+        acq = self.getInputMicrographs().getAcquisition()
+        opticsTable.addRow(1, 'opticsGroup1', inputRefs.getSamplingRate(),
+                           inputRefs.getXDim(), 2, acq.getVoltage(),
+                           acq.getSphericalAberration(),
+                           acq.getAmplitudeContrast())
+        anglesTable = Table(columns=['rlnAngleRot', 'rlnAngleTilt',
+                                     'rlnAnglePsi', 'rlnOpticsGroup'])
+        for rot, tilt in directions:
+            anglesTable.addRow(rot, tilt, 0., 1)
+
+        anglesStar = self._getPath('projection_angles.star')
+        with open(anglesStar, 'w') as f:
+            opticsTable.writeStar(f, tableName='optics')
+            anglesTable.writeStar(f, tableName='particles')
+
+        args = ' --i %s --o %s --ang %s --angpix %0.5f' % (
+            self._getPath('reference_3d.mrc'),
+            pwutils.removeExt(self._getRefProjections()),
+            anglesStar, inputRefs.getSamplingRate())
+        self.runJob('relion_project', args, numberOfMpi=1)
 
     def getAutopickParams(self):
         # Return the autopicking parameters except for the interactive ones:
@@ -335,11 +493,10 @@ class ProtRelion2Autopick(ProtRelionAutopickBase):
         params += ' --angpix %0.5f' % self.getInputMicrographs().getSamplingRate()
         params += ' --shrink %0.3f' % self.shrinkFactor
 
-        if self.doGpu:
-            params += ' --gpu "%s"' % self.gpusToUse
-
         if self.useInputReferences():
             params += ' --ref %s' % abspath(self._getPath('references_2d.mrcs'))
+        elif self._useRefProjections():
+            params += ' --ref %s' % abspath(self._getRefProjections())
         else:  # 3D reference
             params += ' --ref %s' % abspath(self._getPath('reference_3d.mrc'))
             params += ' --sym %s' % self.symmetryGroup
@@ -379,10 +536,12 @@ class ProtRelion2Autopick(ProtRelionAutopickBase):
 
     def _pickMicrographsFromStar(self, micStarFile, cwd, params,
                                  threshold, minDistance,
-                                 maxStddevNoise, minAvgNoise):
+                                 maxStddevNoise, minAvgNoise,
+                                 gpu=None, numberOfMpi=None):
         """ Launch the 'relion_autopick' for micrographs in the inputStarFile.
          If the input set of complete, the star file will contain all the
          micrographs. If working in streaming, it will be only one micrograph.
+         When several GPUs are used, each job receives only one of them.
         """
         params += ' --i %s' % relpath(micStarFile, cwd)
         params += ' --threshold %0.3f' % threshold
@@ -390,9 +549,10 @@ class ProtRelion2Autopick(ProtRelionAutopickBase):
         params += ' --max_stddev_noise %0.3f' % maxStddevNoise
         params += ' --min_avg_noise %0.3f' % minAvgNoise
 
-        program = self._getProgram('relion_autopick')
+        if self.doGpu:
+            params += ' --gpu "%s"' % (self.gpusToUse if gpu is None else gpu)
 
-        self.runJob(program, params, cwd=cwd)
+        self._runAutopick(params, cwd, numberOfMpi)
 
     def createOutputStep(self):
         micSet = self.getInputMicrographsPointer()
@@ -452,6 +612,14 @@ class ProtRelion2Autopick(ProtRelionAutopickBase):
     def useInputReferences(self):
         return self.referencesType == REF_AVERAGES
 
+    def _useRefProjections(self):
+        """ Return True if the 3D reference is projected once and used
+        as 2D references in all batches. """
+        return getattr(self, '_projectRefs', False)
+
+    def _getRefProjections(self):
+        return self._getPath('reference_projections.mrcs')
+
     def getBoxSize(self):
         """ Return a reasonable box-size in pixels. """
         inputRefs = self.getInputReferences()
@@ -26,6 +26,8 @@
 
 import os
 import re
+import json
+import hashlib
 from glob import glob
 from collections import OrderedDict
 from emtable import Table
@@ -44,8 +46,8 @@ from pwem.protocols import EMProtocol
 
 from relion import Plugin
 import relion.convert
-from ..constants import (ANGULAR_SAMPLING_LIST, MASK_FILL_ZERO, 
-                         USE_SCIPION_SCRATCH, USE_CUSTOM_SCRATCH)
+from ..constants import (ANGULAR_SAMPLING_LIST, MASK_FILL_ZERO,
+                         USE_SCIPION_SCRATCH, USE_CUSTOM_SCRATCH, STEP_ARG_REF)
 
 
 class ProtRelionBase(EMProtocol):
@@ -847,6 +849,40 @@ class ProtRelionBase(EMProtocol):
 
         self._insertFunctionStep(self.runRelionStep, params)
 
+    def _storeStepArg(self, value):
+        """ Store a large step argument (e.g. the list of all micrograph
+        names) in a json file of the run folder and return a short reference
+        to be passed to _insertFunctionStep instead of the value itself.
+        The file is named after the hash of its content, so two steps
+        with the same value are still equal when continuing a run.
+        The step function should use _loadStepArg to get the value back.
+        """
+        data = json.dumps(value)
+        key = hashlib.sha1(data.encode()).hexdigest()
+        fn = self._getStepArgFn(key)
+
+        if not os.path.exists(fn):
+            pwutils.makeFilePath(fn)
+            tmpFn = fn + '.tmp'
+            with open(tmpFn, 'w') as f:
+                f.write(data)
+            os.rename(tmpFn, fn)
+
+        return STEP_ARG_REF + key
+
+    def _loadStepArg(self, value):
+        """ Return the value stored with _storeStepArg if the given
+        value is a reference, otherwise return the value unchanged. """
+        if isinstance(value, str) and value.startswith(STEP_ARG_REF):
+            fn = self._getStepArgFn(value[len(STEP_ARG_REF):])
+            with open(fn) as f:
+                return json.load(f)
+
+        return value
+
+    def _getStepArgFn(self, key):
+        return self._getExtraPath('step_args', '%s.json' % key)
+
     # -------------------------- STEPS functions -------------------------------
     def convertInputStep(self, particlesId, copyAlignment):
         """ Create the input file in STAR format as expected by Relion.
@@ -27,7 +27,6 @@
 # ******************************************************************************
 
 import os
-import json
 from enum import Enum
 from emtable import Table
 
@@ -279,9 +278,8 @@ class ProtRelionBayesianPolishing(ProtParticles, ProtRelionBase):
             defectFn = og[ogId].get('rlnMicrographDefectFile', None)
 
             with open(movieStar, 'w') as f:
-                coeffs = json.loads(movie.getAttributeValue('_rlnMotionModelCoeff', '[]'))
+                coeffs, hotpix = convert.readMotionModel(movie)
                 motionMode = 1 if coeffs else 0
-                hotpix = json.loads(movie.getAttributeValue('_rlnHotPixels', '[]'))
 
                 # Update some params in the general table
                 replaceDict = {'rlnMicrographMovieName': movie.getFileName(),
@@ -25,9 +25,16 @@
 # ******************************************************************************
 
 import os
+import json
+import time
+import queue
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import tifffile
 
 from emtools.utils import Timer, Pretty
-from emtools.jobs import Pipeline
 from emtools.pwx import SetMonitor, BatchManager
 from emtools.metadata import StarFile, Table
 
@@ -40,6 +47,59 @@ from pwem.protocols import ProtProcessMovies
 from pwem.objects import MovieAlignment, SetOfMovies, ImageDim, FramesRange
 from pyworkflow.protocol import STEPS_SERIAL
 
+from relion.file_queue import FileQueue
+from relion.prefetch import FilePrefetcher, GB
+
+
+MB = 1024 * 1024
+# Number of movies compressed with each level when tuning the deflate level
+BENCH_MOVIES = 2
+# Columns of the per-batch throughput table written to the extra folder
+BATCH_METRICS = ['batchIndex', 'movies', 'inputBytes', 'outputBytes',
+                 'ratio', 'wallTime', 'mbPerSec', 'queueWait', 'deflateLevel']
+
+
+class BatchJournal:
+    """ Append-only file with the state changes of the processed batches.
+    Each line is a json record with the batch id and its new state. It
+    allows a restarted run to find outputs that were produced but never
+    registered in the output set.
+    """
+    CREATED = 'created'
+    PRODUCED = 'produced'
+    REGISTERED = 'registered'
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+
+    def write(self, batchId, state, **kwargs):
+        """ Durably append a new state for the given batch. """
+        record = dict(id=batchId, state=state, **kwargs)
+        with self._lock:
+            with open(self._filename, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def load(self):
+        """ Return a dict with the merged records of each batch. """
+        batches = OrderedDict()
+        if os.path.exists(self._filename):
+            with open(self._filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # truncated line after a crash
+                        continue
+                    batches.setdefault(record['id'], {}).update(record)
+        return batches
+
+    def pending(self):
+        """ Return the batches that have not been registered. """
+        return [b for b in self.load().values()
+                if b['state'] != self.REGISTERED]
+
 
 class ProtRelionCompressMoviesTasks(ProtProcessMovies):
     """
@@ -76,10 +136,61 @@ class ProtRelionCompressMoviesTasks(ProtProcessMovies):
         group.addParam('compression', params.EnumParam, default=1,
                        choices=['none', 'auto', 'zip', 'lzw'],
                        label='Compression type')
+        group.addParam('autoDeflate', params.BooleanParam, default=False,
+                       condition='compression==2',
+                       label='Tune deflate level automatically?',
+                       help="If Yes, several deflate levels will be "
+                            "benchmarked on the first movies of the first "
+                            "batch, while no other batch is being "
+                            "compressed. The level with the best compression "
+                            "that still meets the estimated target "
+                            "throughput will be used. The benchmark is "
+                            "repeated periodically during streaming.")
         group.addParam('deflateLevel', params.IntParam, default=6,
+                       condition='not autoDeflate',
                        label='Deflate level',
                        help="deflate level. 1 (fast) "
                             "to 9 (slowest but best compression)")
+        group.addParam('targetThroughput', params.FloatParam, default=1000,
+                       condition='autoDeflate',
+                       label='Target throughput (movies/hour)',
+                       help="Minimum number of movies per hour that should "
+                            "be compressed using all threads. If no level "
+                            "meets it, the fastest one will be used.")
+        group.addParam('deflateLevels', params.StringParam, default='1 3 6 9',
+                       condition='autoDeflate',
+                       expertLevel=params.LEVEL_ADVANCED,
+                       label='Deflate levels to test')
+        group.addParam('tuneEvery', params.IntParam, default=50,
+                       condition='autoDeflate',
+                       expertLevel=params.LEVEL_ADVANCED,
+                       label='Re-evaluate every (batches)',
+                       help="Repeat the benchmark every this number of "
+                            "batches. Use 0 to only tune on the first one.")
+
+        line = form.addLine('Frames to keep',
+                            help='First and last frames to write in the '
+                                 'compressed movies (starts counting at 1 '
+                                 'and 0 as last means until the last frame '
+                                 'in the movie). When using EER, the frames '
+                                 'are not hardware frames, but fractions. '
+                                 'Use the same range that will be summed in '
+                                 'motion correction, the other frames will '
+                                 'be dropped.')
+        line.addParam('keepFrame0', params.IntParam, default=1,
+                      label='from')
+        line.addParam('keepFrameN', params.IntParam, default=0,
+                      label='to')
+
+        form.addParam('prefetchSize', params.FloatParam, default=0,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Read-ahead size (GB)',
+                      help="If greater than 0, the movies of the next "
+                           "batches will be read in advance (up to this "
+                           "size) while processing the current ones. "
+                           "This helps when movies are on slow storage. "
+                           "It should be smaller than the free memory "
+                           "available for the file system cache.")
 
         form.addSection("EER")
         form.addParam('eerGroup', params.IntParam, default=32,
@@ -95,6 +206,31 @@ class ProtRelionCompressMoviesTasks(ProtProcessMovies):
                       help="EER upsampling (1 = 4K or 2 = 8K). See "
                            "https://relion.readthedocs.io/en/latest/Reference/MovieCompression.html")
 
+        form.addSection("Distributed")
+        form.addParam('useFileQueue', params.BooleanParam, default=False,
+                      label='Run batches in other nodes?',
+                      help="If Yes, batches will be written to a work queue "
+                           "in a shared folder and processed by workers "
+                           "started in other nodes with:\n"
+                           "*scipion python -m relion.file_queue "
+                           "<queue_folder> --threads N*\n"
+                           "The number of threads of this protocol will be "
+                           "the maximum number of batches in the queue.")
+        form.addParam('queueDir', params.PathParam, default='',
+                      condition='useFileQueue',
+                      label='Queue folder',
+                      help="Shared folder for the work queue. If empty, "
+                           "the queue will be created in the run tmp folder. "
+                           "The project folder should be visible from all "
+                           "worker nodes.")
+        form.addParam('queueTimeout', params.IntParam, default=60,
+                      condition='useFileQueue',
+                      label='Batch timeout (min)',
+                      help="Maximum time to wait for a batch to be processed "
+                           "by the workers (including the time waiting for "
+                           "a free worker). After that, the batch is removed "
+                           "from the queue and marked as failed.")
+
         form.addParallelSection(threads=4, mpi=0)
 
         self._defineStreamingParams(form)
@@ -150,6 +286,10 @@ class ProtRelionCompressMoviesTasks(ProtProcessMovies):
         self.info("Relion version:")
         self._runProgram('--version')
 
+        self._outputMovies = None
+        self._journal = BatchJournal(self._getExtraPath('batch_journal.jsonl'))
+        self._recoverBatches()
+
         moviesMtr = SetMonitor(SetOfMovies,
                                self.inputMovies.get().getFileName(),
                                blacklist=getattr(self, 'outputMovies', None))
@@ -158,31 +298,122 @@ class ProtRelionCompressMoviesTasks(ProtProcessMovies):
         batchMgr = BatchManager(self.streamingBatchSize.get(), moviesIter,
                                 self._getTmpPath())
 
-        self._outputMovies = None
         self._gainFile = self._linkGain()
-        self.cmd = self._getCmd()
+        self._deflateLevel = None
+        if self.getEnumText('compression') == 'zip' and not self.autoDeflate:
+            self._deflateLevel = self.deflateLevel.get()
+        self._tunedIndex = 0
+        self._tuneCond = threading.Condition()
+        self._tuning = False
+        self._converting = 0
+
+        self._fileQueue = None
+        if self.useFileQueue:
+            self._fileQueue = FileQueue(self._getQueueDir())
+            self._fileQueue.create()
+            self.info("Batches will be processed by workers started with: "
+                      "scipion python -m relion.file_queue %s"
+                      % os.path.abspath(self._getQueueDir()))
+
+        self._prefetcher = None
+        if self.prefetchSize.get() > 0:
+            self._prefetcher = FilePrefetcher(int(self.prefetchSize.get() * GB))
+
+        def _generateBatches():
+            for batch in batchMgr.generate():
+                if self._prefetcher is not None:
+                    self._prefetcher.add(m.getFileName()
+                                         for m in batch['items'])
+                yield batch
+
+        self._runBatchWorkers(_generateBatches, self._processBatch,
+                              self._outputFromBatch,
+                              self.numberOfThreads.get())
+
+        if self._fileQueue is not None:
+            self._fileQueue.stop()
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
 
-        pipe = Pipeline()
-        g = pipe.addGenerator(batchMgr.generate)
-        outputQueue = None
-        for i in range(self.numberOfThreads.get()):
-            proc = pipe.addProcessor(g.outputQueue, self._processBatch,
-                                     outputQueue=outputQueue)
-            outputQueue = proc.outputQueue
+        self._updateOutputSet('outputMovies', self._outputMovies,
+                              pwobj.Set.STREAM_CLOSED)
+
+    def _runBatchWorkers(self, generator, processor, collector, nWorkers):
+        """ Run a pool of nWorkers threads that take batches from a single
+        bounded queue filled by the generator. The queue blocks the
+        generator when all workers are busy, limiting the number of batch
+        folders that exist at once. Processed batches are passed to the
+        collector from the calling thread, so only it updates the output.
+        The first exception raised by the generator, the processor or the
+        collector is re-raised in the calling thread, without waiting for
+        the remaining batches (they are recovered from the journal when
+        the protocol is continued).
+        """
+        nWorkers = max(1, nWorkers)
+        batchQueue = queue.Queue(maxsize=nWorkers)
+        doneQueue = queue.Queue()
+        errors = []
 
-        pipe.addProcessor(outputQueue, self._outputFromBatch)
-        pipe.run()
+        def _generate():
+            try:
+                for batch in generator():
+                    if errors:
+                        break
+                    batch['queued'] = time.time()
+                    batchQueue.put(batch)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                for _ in range(nWorkers):
+                    batchQueue.put(None)
+
+        def _work():
+            try:
+                while (batch := batchQueue.get()) is not None:
+                    if errors:
+                        break
+                    batch['wait'] = time.time() - batch['queued']
+                    doneQueue.put(processor(batch))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                doneQueue.put(None)
+
+        threads = [threading.Thread(target=_generate, daemon=True)]
+        threads.extend(threading.Thread(target=_work, daemon=True)
+                       for _ in range(nWorkers))
+        for t in threads:
+            t.start()
+
+        running = nWorkers
+        while running and not errors:
+            batch = doneQueue.get()
+            if batch is None:
+                running -= 1
+            else:
+                try:
+                    collector(batch)
+                except Exception as e:
+                    errors.append(e)
 
-        for batch in batchMgr.generate():
-            self._processBatch(batch)
+        # Threads are daemons, do not wait for them after an error since
+        # the generator could be blocked waiting for new input
+        if errors:
+            raise errors[0]
 
-        self._updateOutputSet('outputMovies', self._outputMovies,
-                              pwobj.Set.STREAM_CLOSED)
+        for t in threads:
+            t.join()
 
     def _processBatch(self, batch):
+        inputFns = [m.getFileName() for m in batch['items']]
         try:
             self.info(pwutils.cyanStr(f">>> Processing batch {batch['path']}"))
+            t0 = time.time()
             batchPath = batch['path']
+            self._journal.write(batch['id'], BatchJournal.CREATED,
+                                index=batch['index'], path=batchPath,
+                                movies=[[m.getObjId(), self._getOutputFn(m)]
+                                        for m in batch['items']])
             starFn = os.path.join(batchPath, 'movies.star')
             with StarFile(starFn, 'w') as sf:
                 t = Table(['rlnMicrographMovieName'])
@@ -193,19 +424,29 @@ class ProtRelionCompressMoviesTasks(ProtProcessMovies):
                     t.addRowValues(bn)
                 sf.writeTable('movies', t)
 
-            self._runProgram(self.cmd, cwd=batch['path'])
+            batch['deflateLevel'] = self._getBatchDeflateLevel(batch)
+            inputBytes = sum(os.path.getsize(m.getFileName())
+                             for m in batch['items'])
+            outputBytes = 0
 
-            # Check resulting files and update movies
-            for movie in batch['items']:
-                fn = movie.getFileName()
-                tifBn = pwutils.replaceExt(os.path.basename(fn), 'tif')
-                outputFn = os.path.join(batchPath, tifBn)
-                dstFn = self._getExtraPath(tifBn)
-                if os.path.exists(outputFn):
-                    pwutils.moveFile(outputFn, dstFn)
-                    movie.setFileName(dstFn)
-                else:
-                    movie.setFileName(None)
+            try:
+                self._runBatchProgram(batch,
+                                      self._getCmd(batch['deflateLevel']))
+
+                # Check resulting files and update movies
+                for movie in batch['items']:
+                    dstFn = self._getOutputFn(movie)
+                    outputFn = os.path.join(batchPath,
+                                            os.path.basename(dstFn))
+                    if os.path.exists(outputFn):
+                        batch['frames'] = self._keepFrames(outputFn)
+                        outputBytes += os.path.getsize(outputFn)
+                        pwutils.moveFile(outputFn, dstFn)
+                        movie.setFileName(dstFn)
+                    else:
+                        movie.setFileName(None)
+            finally:
+                self._releaseBatchDeflateLevel()
 
             gain = 'gain-reference.mrc'
             outputGain = os.path.join(batchPath, gain)
@@ -213,10 +454,16 @@ class ProtRelionCompressMoviesTasks(ProtProcessMovies):
             if os.path.exists(outputGain) and not os.path.exists(newGain):
                 pwutils.moveFile(outputGain, newGain)
 
+            self._journal.write(batch['id'], BatchJournal.PRODUCED)
+
             # Clean batch folder if not in debug mode
             if not pwutils.envVarOn(SCIPION_DEBUG_NOCLEAN):
                 os.system('rm -rf %s' % batchPath)
 
+            batch['metrics'] = self._getBatchMetrics(batch, inputBytes,
+                                                     outputBytes,
+                                                     time.time() - t0)
+
         except Exception as e:
             eStr = str(e)
             self.error("ERROR: relion_convert_to_tiff has failed for batch %s. --> %s\n"
@@ -225,9 +472,183 @@ class ProtRelionCompressMoviesTasks(ProtProcessMovies):
             import traceback
             traceback.print_exc()
 
+        if self._prefetcher is not None:
+            self._prefetcher.release(inputFns)
+
         return batch
 
+    def _keepFrames(self, tifFn):
+        """ Rewrite the tiff file with only the frames in the range to keep.
+        The compressed strips of the kept frames are copied as they are,
+        so frames are not decompressed and compressed again. The file is
+        not rewritten if all frames are kept. Return the number of
+        output frames.
+        """
+        first, last = self.keepFrame0.get(), self.keepFrameN.get()
+
+        with tifffile.TiffFile(tifFn) as tif:
+            n = len(tif.pages)
+            last = n if last <= 0 else min(last, n)
+            if first <= 1 and last == n:
+                return n
+
+            pages = tif.pages[first - 1:last]
+            page = pages[0]
+            fh = tif.filehandle
+
+            def _iterStrips():
+                for p in pages:
+                    for offset, count in zip(p.dataoffsets, p.databytecounts):
+                        fh.seek(offset)
+                        yield fh.read(count)
+
+            tmpFn = tifFn + '.tmp'
+            tifffile.imwrite(tmpFn, _iterStrips(),
+                             shape=(len(pages),) + page.shape,
+                             dtype=page.dtype, photometric='minisblack',
+                             compression=page.compression,
+                             predictor=page.predictor,
+                             rowsperstrip=page.rowsperstrip)
+        os.replace(tmpFn, tifFn)
+
+        return len(pages)
+
+    def _getBatchMetrics(self, batch, inputBytes, outputBytes, wallTime):
+        """ Return the throughput values of a processed batch,
+        in the same order as BATCH_METRICS. """
+        ratio = inputBytes / outputBytes if outputBytes else 0.
+        mbPerSec = inputBytes / MB / wallTime if wallTime else 0.
+        self.info(f"Batch {batch['index']}: {len(batch['items'])} movies, "
+                  f"{Pretty.size(inputBytes)} -> {Pretty.size(outputBytes)} "
+                  f"(ratio {ratio:0.2f}) in {wallTime:0.1f} s, "
+                  f"{mbPerSec:0.1f} MB/s, queue wait {batch['wait']:0.1f} s")
+
+        return [batch['index'], len(batch['items']), inputBytes, outputBytes,
+                ratio, wallTime, mbPerSec, batch['wait'],
+                batch['deflateLevel'] or 0]
+
+    def _getBatchDeflateLevel(self, batch):
+        """ Return the deflate level to use for this batch and count the
+        batch as being compressed until _releaseBatchDeflateLevel is called.
+        In auto mode, the level is tuned on the first batch and re-evaluated
+        every tuneEvery batches. The benchmark waits until no other batch
+        is being compressed and the other workers wait for it to finish,
+        so its timing is not disturbed by them.
+        """
+        tuneEvery = self.tuneEvery.get()
+        with self._tuneCond:
+            self._tuneCond.wait_for(lambda: not self._tuning)
+            tune = self._useAutoDeflate() and (
+                self._deflateLevel is None or
+                tuneEvery > 0 and
+                batch['index'] - self._tunedIndex >= tuneEvery)
+            if not tune:
+                self._converting += 1
+                return self._deflateLevel
+            self._tuning = True
+            self._tuneCond.wait_for(lambda: self._converting == 0)
+
+        try:
+            self._deflateLevel = self._tuneDeflateLevel(batch)
+            self._tunedIndex = batch['index']
+        except Exception:
+            with self._tuneCond:
+                self._tuning = False
+                self._tuneCond.notify_all()
+            raise
+
+        with self._tuneCond:
+            self._tuning = False
+            self._converting += 1
+            self._tuneCond.notify_all()
+
+        return self._deflateLevel
+
+    def _releaseBatchDeflateLevel(self):
+        """ Mark that a batch is not being compressed anymore. """
+        with self._tuneCond:
+            self._converting -= 1
+            self._tuneCond.notify_all()
+
+    def _tuneDeflateLevel(self, batch):
+        """ Compress the first movies of the batch with each candidate level
+        and choose the level with the smallest output that meets the target
+        throughput, or the fastest one if none of them does.
+        The throughput of all workers is estimated from the time of a
+        single one, so it is only an approximation.
+        """
+        movieBns = [os.path.basename(m.getFileName())
+                    for m in batch['items'][:BENCH_MOVIES]]
+        benchStar = 'bench_movies.star'
+        benchFiles = [os.path.join(batch['path'], benchStar)]
+        with StarFile(benchFiles[0], 'w') as sf:
+            t = Table(['rlnMicrographMovieName'])
+            for movieBn in movieBns:
+                t.addRowValues(movieBn)
+            sf.writeTable('movies', t)
+
+        nWorkers = max(1, self.numberOfThreads.get())
+        results = []
+        try:
+            for level in self._getDeflateLevels():
+                outDir = 'bench_%d' % level
+                benchFiles.append(os.path.join(batch['path'], outDir))
+                pwutils.makePath(benchFiles[-1])
+                t0 = time.time()
+                self._runProgram(self._getCmd(level, inputStar=benchStar,
+                                              outputDir=outDir + '/'),
+                                 cwd=batch['path'])
+                elapsed = (time.time() - t0) / len(movieBns)
+                size = sum(os.path.getsize(
+                    os.path.join(benchFiles[-1],
+                                 pwutils.replaceExt(movieBn, 'tif')))
+                    for movieBn in movieBns) / len(movieBns)
+                moviesPerHour = nWorkers * 3600 / elapsed if elapsed else 0
+                self.info(f"Deflate level {level}: {Pretty.size(size)} "
+                          f"in {elapsed:0.1f} s per movie, estimated "
+                          f"{moviesPerHour:0.0f} movies/hour")
+                results.append((level, size, moviesPerHour))
+        finally:
+            pwutils.cleanPath(*benchFiles)
+
+        target = self.targetThroughput.get()
+        valid = [r for r in results if r[2] >= target]
+        if valid:
+            level = min(valid, key=lambda r: r[1])[0]
+        else:
+            level = max(results, key=lambda r: r[2])[0]
+            self.warning(f"No deflate level reaches {target:0.0f} "
+                         f"movies/hour, using the fastest one.")
+        self.info(pwutils.greenStr(f"Using deflate level {level} "
+                                   f"from batch {batch['index']}"))
+
+        return level
+
+    def _getDeflateLevels(self):
+        return [int(v) for v in self.deflateLevels.get().split()]
+
+    def _useAutoDeflate(self):
+        return self.autoDeflate and self.getEnumText('compression') == 'zip'
+
+    def _writeBatchMetrics(self, metrics):
+        """ Append a row with the batch metrics to the run metrics table. """
+        metricsFn = self._getBatchMetricsFn()
+        newFile = not os.path.exists(metricsFn)
+        t = Table(BATCH_METRICS)
+        t.addRowValues(*metrics)
+
+        with StarFile(metricsFn, 'a') as sf:
+            if newFile:
+                sf.writeHeader('batches', t)
+            sf.writeRow(t[0])
+
+    def _getBatchMetricsFn(self):
+        return self._getExtraPath('batch_metrics.star')
+
     def _outputFromBatch(self, batch):
+        if 'metrics' in batch:
+            self._writeBatchMetrics(batch['metrics'])
+
         # First time we are running this function for this execution
         firstOutput = False
 
@@ -238,12 +659,18 @@ class ProtRelionCompressMoviesTasks(ProtProcessMovies):
                 outputMovies.setStreamState(pwobj.Set.STREAM_OPEN)
                 outputMovies.copyInfo(self.inputMovies.get())
                 m = batch['items'][0]
-                dim = m.getDim()
-                outputMovies.setDim(dim)  # Clear image dim
-                framesRange = [1, dim[2], 1]
+                x, y, n = m.getDim()
+                n = batch.get('frames', n)
+                outputMovies.setDim((x, y, n))  # Clear image dim
+                framesRange = [1, n, 1]
                 acq = outputMovies.getAcquisition()
-                newDose = acq.getDosePerFrame() * self.eerGroup.get()
+                newDose = acq.getDosePerFrame()
+                if self.isEER:
+                    newDose *= self.eerGroup.get()
                 acq.setDosePerFrame(newDose)
+                # Dropped initial frames are added to the pre-exposure
+                acq.setDoseInitial(acq.getDoseInitial() +
+                                   (self.keepFrame0.get() - 1) * newDose)
                 outputMovies.setFramesRange(framesRange)
                 outputGain = self._getExtraPath('gain-reference.mrc')
                 if os.path.exists(outputGain):
@@ -272,6 +699,44 @@ class ProtRelionCompressMoviesTasks(ProtProcessMovies):
         if firstOutput:
             self._defineSourceRelation(self.inputMovies, outputMovies)
 
+        self._journal.write(batch['id'], BatchJournal.REGISTERED)
+
+    def _recoverBatches(self):
+        """ Register the movies of batches from a previous execution whose
+        output files were moved to the extra folder but were not added to
+        the output set. The remaining movies of those batches are not in
+        the output, so they will be processed again in new batches.
+        """
+        pending = self._journal.pending()
+        if not pending:
+            return
+
+        outputMovies = getattr(self, 'outputMovies', None)
+        doneIds = set() if outputMovies is None else set(outputMovies.getIdSet())
+        inputMovies = SetOfMovies(filename=self.inputMovies.get().getFileName())
+
+        for b in pending:
+            items = []
+            for movieId, outputFn in b.get('movies', []):
+                if movieId not in doneIds and os.path.exists(outputFn):
+                    movie = inputMovies[movieId].clone()
+                    movie.setFileName(outputFn)
+                    items.append(movie)
+
+            pwutils.cleanPath(b['path'])
+
+            if items:
+                self.info(f"Recovering {len(items)} movies from "
+                          f"batch {b['id']}")
+                with tifffile.TiffFile(items[0].getFileName()) as tif:
+                    frames = len(tif.pages)
+                self._outputFromBatch({'id': b['id'], 'index': b['index'],
+                                       'items': items, 'frames': frames})
+            else:
+                self._journal.write(b['id'], BatchJournal.REGISTERED)
+
+        inputMovies.close()
+
     def _processMovie(self, movie):
         raise Exception("Not processing individual movies.")
 
@@ -280,6 +745,36 @@ class ProtRelionCompressMoviesTasks(ProtProcessMovies):
         summary = ["Movies compressed by relion_convert_to_tiff, "
                    "compression type: %s" % self.getEnumText('compression')]
 
+        metricsFn = self._getBatchMetricsFn()
+        if os.path.exists(metricsFn):
+            with StarFile(metricsFn) as sf:
+                t = sf.getTable('batches')
+
+            def _percentiles(colName):
+                values = np.array(t.getColumnValues(colName), dtype=float)
+                return "%0.1f / %0.1f / %0.1f" % tuple(
+                    np.percentile(values, [10, 50, 90]))
+
+            inputBytes = sum(t.getColumnValues('inputBytes'))
+            outputBytes = sum(t.getColumnValues('outputBytes'))
+            summary.append("Batches processed: *%d*, total size: %s -> %s"
+                           % (len(t), Pretty.size(inputBytes),
+                              Pretty.size(outputBytes)))
+            summary.append("Percentiles (p10 / p50 / p90):")
+            summary.append("    MB/s: %s" % _percentiles('mbPerSec'))
+            summary.append("    Compression ratio: %s"
+                           % _percentiles('ratio'))
+            summary.append("    Batch time (s): %s"
+                           % _percentiles('wallTime'))
+            summary.append("    Queue wait (s): %s"
+                           % _percentiles('queueWait'))
+
+            if self._useAutoDeflate():
+                levels = sorted(set(t.getColumnValues('deflateLevel')))
+                summary.append("Deflate levels used: %s (chosen from the "
+                               "estimated throughput of a short benchmark)"
+                               % ', '.join(str(v) for v in levels))
+
         return summary
 
     def _citations(self):
@@ -292,6 +787,24 @@ class ProtRelionCompressMoviesTasks(ProtProcessMovies):
 
         errors.extend(ProtProcessMovies._validate(self))
 
+        _, lastFrame, _ = self.inputMovies.get().getFramesRange()
+        if self.isEER:
+            lastFrame //= self.eerGroup.get()
+        first, last = self.keepFrame0.get(), self.keepFrameN.get()
+        if not (1 <= first <= lastFrame and
+                (last == 0 or first < last <= lastFrame)):
+            errors.append("Frames range to keep must be within %d - %d"
+                          % (1, lastFrame))
+
+        if self._useAutoDeflate():
+            try:
+                levels = self._getDeflateLevels()
+                if not levels or any(not 1 <= v <= 9 for v in levels):
+                    raise ValueError
+            except ValueError:
+                errors.append("Deflate levels to test should be a list of "
+                              "integers between 1 and 9.")
+
         return errors
 
     def _warnings(self):
@@ -303,15 +816,15 @@ class ProtRelionCompressMoviesTasks(ProtProcessMovies):
         return warnings
 
     # --------------------------- UTILS functions -----------------------------
-    def _getCmd(self):
+    def _getCmd(self, deflateLevel, inputStar='movies.star', outputDir='./'):
         """ Set return a command string that will be used for each batch. """
         compression = self.getEnumText('compression')
-        cmd = " --i movies.star --o ./ "
+        cmd = " --i %s --o %s " % (inputStar, outputDir)
         cmd += " --compression %s" % compression
 
         # TODO: Check if deflateLevel is only valid for zip (deflate)
         if compression == 'zip':  # deflate
-            cmd += " --deflate_level %d" % self.deflateLevel
+            cmd += " --deflate_level %d" % deflateLevel
 
         # Gain file is expected at the run working folder
         # so, two levels up from tmp batch folder
@@ -324,6 +837,32 @@ class ProtRelionCompressMoviesTasks(ProtProcessMovies):
 
         return cmd
 
+    def _getOutputFn(self, movie):
+        """ Return the final compressed file for this movie. """
+        tifBn = pwutils.replaceExt(os.path.basename(movie.getFileName()), 'tif')
+        return self._getExtraPath(tifBn)
+
+    def _getQueueDir(self):
+        return self.queueDir.get('').strip() or self._getTmpPath('queue')
+
+    def _runBatchProgram(self, batch, cmd):
+        """ Run the command for this batch, either locally or through
+        the file queue if distributed mode is used. """
+        if self._fileQueue is None:
+            self._runProgram(cmd, cwd=batch['path'])
+        else:
+            self._fileQueue.submit(batch['id'], 'relion_convert_to_tiff',
+                                   cmd, batch['path'])
+            result = self._fileQueue.wait(
+                batch['id'], timeout=self.queueTimeout.get() * 60)
+            self.info(f"Batch {batch['index']} processed in {result['host']} "
+                      f"in {result['elapsed']:0.1f} s")
+            if result['returnCode'] != 0:
+                raise Exception("relion_convert_to_tiff failed in %s, see %s"
+                                % (result['host'],
+                                   os.path.join(batch['path'],
+                                                'relion_convert_to_tiff.log')))
+
     def _runProgram(self, cmd, **kwargs):
         # We are using Scipion parallelization in batches, so not using MPI here
         self.runJob('relion_convert_to_tiff', cmd, numberOfMpi=1, **kwargs)
@@ -25,8 +25,11 @@
 # **************************************************************************
 
 import os
+import hashlib
+from math import ceil
+from concurrent.futures import ThreadPoolExecutor
 
-from pyworkflow.object import Set, Integer
+from pyworkflow.object import Set, Integer, Boolean
 import pyworkflow.utils as pwutils
 from pyworkflow.protocol.constants import STATUS_FINISHED
 import pyworkflow.protocol.params as params
@@ -124,6 +127,30 @@ class ProtRelionExtractParticles(ProtExtractParticles, ProtRelionBase):
 
         self._defineStreamingParams(form)
 
+        form.addParam('numberOfShards', params.IntParam, default=1,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Number of extraction groups',
+                      help='Split the micrographs of each step into this '
+                           'number of groups, that are extracted by '
+                           'independent relion_preprocess jobs running at '
+                           'the same time. The MPI processes are divided '
+                           'among the groups, so there are at most as many '
+                           'groups as MPI processes.')
+
+        form.addParam('previousRun', params.PointerParam,
+                      pointerClass='ProtRelionExtractParticles',
+                      allowsNull=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Reuse previous extraction',
+                      help='Select a previous extraction run to reuse the '
+                           'particles of the micrographs that have not '
+                           'changed. A micrograph is only extracted again '
+                           'if its coordinates or the extraction parameters '
+                           '(box size, rescaling, normalization...) are '
+                           'different from the previous run, otherwise the '
+                           'stack and the particles of the previous run '
+                           'are linked.')
+
         form.addParallelSection(threads=0, mpi=4)
 
     # -------------------------- INSERT steps functions -----------------------
@@ -149,6 +176,15 @@ class ProtRelionExtractParticles(ProtExtractParticles, ProtRelionBase):
     def _doNothing(self, *args):
         pass  # used to avoid some streaming functions
 
+    def _insertExtractMicrographListStep(self, micList, prerequisites, *args):
+        """ Store the list of micrograph names by reference, since it
+        can contain all input micrographs if not working in streaming.
+        """
+        micNames = self._storeStepArg([mic.getMicName() for mic in micList])
+        return self._insertFunctionStep('extractMicrographListStep',
+                                        micNames, *args,
+                                        prerequisites=prerequisites)
+
     # -------------------------- STEPS functions ------------------------------
     def convertInputStep(self, micsId):
         self.info("Relion version:")
@@ -156,6 +192,10 @@ class ProtRelionExtractParticles(ProtExtractParticles, ProtRelionBase):
         self.info("Detected version from config: %s"
                   % Plugin.getActiveVersion())
 
+    def extractMicrographListStep(self, micKeyList, *args):
+        ProtExtractParticles.extractMicrographListStep(
+            self, self._loadStepArg(micKeyList), *args)
+
     def _convertCoordinates(self, mic, coordList):
         relion.convert.writeMicCoordinates(
             mic, coordList, self._getMicPos(mic), getPosFunc=self._getPos)
@@ -169,6 +209,40 @@ class ProtRelionExtractParticles(ProtExtractParticles, ProtRelionBase):
         if len(micList) <= 0:  # do not process when empty list, need to check this properly
             return
 
+        micList = self._reuseMicrographs(micList, params)
+        if not micList:
+            return
+
+        # Never run more jobs than MPI processes, each one needs at least one
+        numberOfMpi = self.numberOfMpi.get()
+        nShards = min(self.getAttributeValue('numberOfShards', 1),
+                      len(micList), numberOfMpi)
+        if nShards <= 1:
+            self._extractShard(micList, params, numberOfMpi)
+            return
+
+        # Split the micrographs in groups extracted concurrently, each
+        # group writes its own star files and the particles of each
+        # micrograph are read later in readPartsFromMics
+        shardSize = ceil(len(micList) / nShards)
+        shards = [micList[i:i + shardSize]
+                  for i in range(0, len(micList), shardSize)]
+        # Divide the MPI processes among the groups, the first ones
+        # take the remaining processes
+        mpis = [numberOfMpi // len(shards) +
+                (1 if i < numberOfMpi % len(shards) else 0)
+                for i in range(len(shards))]
+        self.info("Extracting %d micrographs in %d groups"
+                  % (len(micList), len(shards)))
+
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            futures = [executor.submit(self._extractShard, shard, params, mpi)
+                       for shard, mpi in zip(shards, mpis)]
+            for future in futures:
+                future.result()  # Raise any error of the extraction jobs
+
+    def _extractShard(self, micList, params, numberOfMpi):
+        """ Run relion_preprocess for this list of micrographs. """
         workingDir = self.getWorkingDir()
         micsStar = self._getMicsStar(micList)
         og = OpticsGroups.fromImages(self.getInputMicrographs())
@@ -189,7 +263,58 @@ class ProtRelionExtractParticles(ProtExtractParticles, ProtRelionBase):
 
         args = ' --i %s --part_star %s %s' % (micsStar, partsStar, params)
 
-        self.runJob(self._getProgram('relion_preprocess'), args, cwd=workingDir)
+        program = 'relion_preprocess' + ('_mpi' if numberOfMpi > 1 else '')
+        self.runJob(program, args, cwd=workingDir, numberOfMpi=numberOfMpi)
+
+    def _reuseMicrographs(self, micList, params):
+        """ Write the hash of the extraction of each micrograph and link
+        the results of the previous run when the hash has not changed.
+        Return the micrographs that need to be extracted.
+        """
+        prevRun = self.previousRun.get()
+        tmp = self._getTmpPath()
+        newMics = []
+
+        for mic in micList:
+            micHash = self._getMicHash(mic, params)
+            hashFile = self.__getMicFile(mic, '.sha1', folder=tmp)
+            with open(hashFile, 'w') as f:
+                f.write(micHash)
+
+            if prevRun is not None and self._isMicReusable(prevRun, mic, micHash):
+                for ext in ['.mrcs', '_extract.star']:
+                    pwutils.createLink(prevRun.__getMicFile(mic, ext),
+                                       self.__getMicFile(mic, ext, folder=tmp))
+            else:
+                newMics.append(mic)
+
+        if len(newMics) < len(micList):
+            self.info("Reusing %d micrographs from previous run %s"
+                      % (len(micList) - len(newMics), prevRun.getRunName()))
+
+        return newMics
+
+    def _isMicReusable(self, prevRun, mic, micHash):
+        """ Check if the previous run extracted this micrograph with the
+        same coordinates and parameters. """
+        prevHashFile = prevRun.__getMicFile(mic, '.sha1')
+        if not all(os.path.exists(prevRun.__getMicFile(mic, ext))
+                   for ext in ['.mrcs', '_extract.star']):
+            return False
+        try:
+            with open(prevHashFile) as f:
+                return f.read().strip() == micHash
+        except OSError:
+            return False
+
+    def _getMicHash(self, mic, params):
+        """ Hash of everything that determines the extracted particles of
+        this micrograph: input file, coordinates and extraction args. """
+        positions = sorted(self._getPos(c)
+                           for c in self.coordDict[mic.getObjId()])
+        data = '%s %s %s %s' % (mic.getMicName(), mic.getFileName(),
+                                params, positions)
+        return hashlib.sha1(data.encode()).hexdigest()
 
     def createOutputStep(self):
         pass
@@ -339,7 +464,15 @@ class ProtRelionExtractParticles(ProtExtractParticles, ProtRelionBase):
 
             ogNumber = mic.getAttributeValue('_rlnOpticsGroup', 1)
 
-            partsStar = self.__getMicFile(mic, '_extract.star', folder=tmp)
+            # Keep the particles star and the extraction hash next to
+            # the stack, so later runs can reuse them
+            for ext in ['_extract.star', '.sha1']:
+                micFile = self.__getMicFile(mic, ext, folder=tmp)
+                if os.path.exists(micFile):
+                    pwutils.moveFile(micFile,
+                                     self.__getMicFile(mic, ext, folder=extra))
+
+            partsStar = self.__getMicFile(mic, '_extract.star', folder=extra)
             partsTable = relion.convert.Table(fileName=partsStar)
             stackFile = self.__getMicFile(mic, '.mrcs', folder=tmp)
             endStackFile = self.__getMicFile(mic, '.mrcs', folder=extra)
@@ -379,6 +512,8 @@ class ProtRelionExtractParticles(ProtExtractParticles, ProtRelionBase):
             og.updateAll(rlnImagePixelSize=self._getNewSampling(),
                          rlnImageSize=self.getNewImgSize())
             og.toImages(outputSet)
+            # Keep track of the stacks format for later protocols
+            outputSet._mrcFloat16 = Boolean(self.saveFloat16.get())
 
         ProtExtractParticles._updateOutputSet(self, outputName, outputSet,
                                               state=state)
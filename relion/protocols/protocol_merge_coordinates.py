@@ -0,0 +1,172 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from enum import Enum
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import pyworkflow.protocol.params as params
+from pyworkflow.constants import PROD
+from pyworkflow.object import Float, Integer
+from pwem.protocols import ProtParticlePicking
+from pwem.objects import SetOfCoordinates, Coordinate
+
+import relion.convert as convert
+
+
+class outputs(Enum):
+    outputCoordinates = SetOfCoordinates
+
+
+class ProtRelionMergeCoordinates(ProtParticlePicking):
+    """ Merge coordinates from several pickers removing near-duplicates.
+
+    For each micrograph, coordinates closer than the given distance are
+    considered the same particle and only the one with the highest
+    autopicking figure-of-merit is kept. If the figure-of-merit is not
+    available, the coordinates of the first input sets are preferred.
+    """
+    _label = 'merge coordinates'
+    _devStatus = PROD
+    _possibleOutputs = outputs
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputCoordinates', params.MultiPointerParam,
+                      pointerClass='SetOfCoordinates',
+                      important=True,
+                      label="Input coordinates",
+                      help='Select the sets of coordinates to merge. The '
+                           'micrographs of the first set are used for the '
+                           'output, coordinates of the other sets are '
+                           'matched by micrograph name and scaled to its '
+                           'pixel size.')
+        form.addParam('minDistance', params.FloatParam, default=50,
+                      validators=[params.Positive],
+                      label='Minimum distance (A)',
+                      help='Coordinates of the same micrograph closer than '
+                           'this distance are considered duplicates, only '
+                           'the one with the highest figure-of-merit is '
+                           'kept. A reasonable value is about half of the '
+                           'particle diameter.')
+
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep(self.createOutputStep)
+
+    # --------------------------- STEPS functions -----------------------------
+    def createOutputStep(self):
+        inputSets = [p.get() for p in self.inputCoordinates]
+        micSet = inputSets[0].getMicrographs()
+        samplingRate = micSet.getSamplingRate()
+        micDict = {mic.getMicName(): mic.clone() for mic in micSet}
+
+        # Load the coordinates of all sets grouped by micrograph
+        # as rows of: x, y, fom, class, psi
+        coordsDict = defaultdict(list)
+        hasFom = False
+        for coordSet in inputSets:
+            scale = coordSet.getMicrographs().getSamplingRate() / samplingRate
+            for coord in coordSet.iterItems():
+                micName = coord.getMicName()
+                if micName not in micDict:
+                    continue
+                fom = coord.getAttributeValue('_rlnAutopickFigureOfMerit')
+                hasFom = hasFom or fom is not None
+                coordsDict[micName].append(
+                    (coord.getX() * scale, coord.getY() * scale,
+                     -np.inf if fom is None else fom,
+                     coord.getAttributeValue('_rlnClassNumber', 0),
+                     coord.getAttributeValue('_rlnAnglePsi', -999.)))
+
+        minDistance = self.minDistance.get() / samplingRate
+
+        def _merge(micName):
+            data = np.array(coordsDict[micName], dtype=float)
+            keep = convert.removeNearDuplicates(data[:, :2], data[:, 2],
+                                                minDistance)
+            return micName, data[keep]
+
+        coordSet = self._createSetOfCoordinates(micSet)
+        coordSet.setBoxSize(inputSets[0].getBoxSize())
+        coord = Coordinate()
+        if hasFom:
+            coord._rlnAutopickFigureOfMerit = Float()
+            coord._rlnClassNumber = Integer()
+            coord._rlnAnglePsi = Float()
+
+        with ThreadPoolExecutor(max_workers=max(1, self.numberOfThreads.get())) as executor:
+            for micName, data in executor.map(_merge, list(coordsDict)):
+                mic = micDict[micName]
+                for x, y, fom, classNumber, psi in data:
+                    coord.setObjId(None)
+                    coord.setPosition(int(round(x)), int(round(y)))
+                    coord.setMicrograph(mic)
+                    if hasFom:
+                        coord._rlnAutopickFigureOfMerit.set(
+                            fom if np.isfinite(fom) else 0.)
+                        coord._rlnClassNumber.set(int(classNumber))
+                        coord._rlnAnglePsi.set(psi)
+                    coordSet.append(coord)
+
+        coordSet.setObjComment(self.getSummary(coordSet))
+        self._defineOutputs(**{outputs.outputCoordinates.name: coordSet})
+        for inputPointer in self.inputCoordinates:
+            self._defineSourceRelation(inputPointer, coordSet)
+
+    # --------------------------- UTILS functions -----------------------------
+    def getInputMicrographsPointer(self):
+        return self.inputCoordinates[0].get().getMicrographs(asPointer=True)
+
+    def getInputMicrographs(self):
+        if not len(self.inputCoordinates):
+            return None
+        return self.inputCoordinates[0].get().getMicrographs()
+
+    # --------------------------- INFO functions ------------------------------
+    def _validate(self):
+        errors = []
+
+        if not len(self.inputCoordinates):
+            errors.append("Select at least one set of coordinates.")
+
+        return errors
+
+    def _summary(self):
+        summary = []
+
+        if hasattr(self, outputs.outputCoordinates.name):
+            inputSize = sum(p.get().getSize() for p in self.inputCoordinates)
+            outputSize = self.outputCoordinates.getSize()
+            summary.append("Input coordinates: %d" % inputSize)
+            summary.append("Output coordinates: %d" % outputSize)
+            summary.append("Removed near-duplicates (< %0.1f A): %d"
+                           % (self.minDistance, inputSize - outputSize))
+
+        return summary
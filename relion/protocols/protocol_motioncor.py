@@ -27,8 +27,16 @@
 # ******************************************************************************
 
 import os
+import io
+import re
+import shutil
+import hashlib
 from math import ceil
-import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import mrcfile
+from PIL import Image as PILImage
 import emtable as md
 
 import pyworkflow.object as pwobj
@@ -37,7 +45,7 @@ import pyworkflow.protocol.constants as cons
 from pyworkflow.constants import PROD
 import pyworkflow.utils as pwutils
 from pwem.protocols import ProtAlignMovies
-from pwem.objects import Image
+from pwem.objects import Image, SetOfMovies, Movie
 from pyworkflow.gui.plotter import Plotter
 from pyworkflow.protocol import STEPS_SERIAL
 
@@ -45,9 +53,14 @@ import relion
 from relion import Plugin
 import relion.convert as convert
 from relion.convert.convert31 import OpticsGroups
+from relion.prefetch import FilePrefetcher, GB
 from .protocol_base import ProtRelionBase
 
 
+# Prefix of cached files named after the movie
+CACHE_PREFIX = 'movie'
+
+
 class ProtRelionMotioncor(ProtAlignMovies, ProtRelionBase):
     """ Wrapper for the Relion's implementation of motioncor algorithm. """
 
@@ -59,6 +72,12 @@ class ProtRelionMotioncor(ProtAlignMovies, ProtRelionBase):
         self.stepsExecutionMode = STEPS_SERIAL
         self.updatedSets = []
         self.isEER = False
+        self._batchMovies = None
+        self._extraPool = None
+        self._extraFutures = {}
+        self._movieInfo = {}
+        self._plotRenderer = None
+        self._prefetcher = None
 
     def _getConvertExtension(self, filename):
         """ Check whether it is needed to convert to .mrc or not """
@@ -114,20 +133,64 @@ class ProtRelionMotioncor(ProtAlignMovies, ProtRelionBase):
         form.addParam('doComputePSD', params.BooleanParam, default=False,
                       label="Compute PSD?",
                       help="If Yes, the protocol will compute for each "
-                           "aligned micrograph the PSD using EMAN2.")
+                           "aligned micrograph the PSD.")
 
         form.addParam('doComputeMicThumbnail', params.BooleanParam,
                       default=False,
                       label='Compute micrograph thumbnail?',
                       help='When using this option, we will compute a '
-                           'micrograph thumbnail with EMAN2 and keep it with the '
+                           'micrograph thumbnail and keep it with the '
                            'micrograph object for visualization purposes.')
 
+        form.addParam('deferPlots', params.BooleanParam, default=False,
+                      expertLevel=cons.LEVEL_ADVANCED,
+                      label='Render alignment plots on demand?',
+                      help="If Yes, the global alignment plots will not be "
+                           "generated during processing, but when the "
+                           "results are displayed with the viewer.")
+
         form.addParam('extraParams', params.StringParam, default='',
                       expertLevel=cons.LEVEL_ADVANCED,
                       label='Additional arguments',
                       help="Extra parameters for Relion motion correction. ")
 
+        form.addParam('useCache', params.BooleanParam, default=False,
+                      expertLevel=cons.LEVEL_ADVANCED,
+                      label='Use results cache?',
+                      help="If Yes, the results of each movie will be "
+                           "stored in the cache folder, and movies that "
+                           "were already processed with the same "
+                           "parameters (in this or other projects) will "
+                           "not be processed again, their results will "
+                           "be linked from the cache.")
+        form.addParam('cacheDir', params.PathParam, default='',
+                      condition='useCache',
+                      expertLevel=cons.LEVEL_ADVANCED,
+                      label='Cache folder',
+                      help="Folder where the results are cached. It can be "
+                           "shared by several projects.")
+
+        form.addParam('moviesPerBatch', params.IntParam, default=1,
+                      expertLevel=cons.LEVEL_ADVANCED,
+                      label='Movies per batch',
+                      help="Number of movies processed by a single call to "
+                           "relion_run_motioncorr. Using batches avoids "
+                           "starting the program and loading the gain "
+                           "reference for every movie. When streaming, "
+                           "batches will be smaller if there are not "
+                           "enough new movies available. "
+                           "Use 1 to process each movie separately.")
+
+        form.addParam('prefetchSize', params.FloatParam, default=0,
+                      expertLevel=cons.LEVEL_ADVANCED,
+                      label='Read-ahead size (GB)',
+                      help="If greater than 0, the next movies to be "
+                           "processed will be read in advance (up to this "
+                           "size) while processing the current ones. "
+                           "This helps when movies are on slow storage. "
+                           "It should be smaller than the free memory "
+                           "available for the file system cache.")
+
         form.addSection("Motion")
         form.addParam('bfactor', params.IntParam, default=150,
                       label='Bfactor',
@@ -218,6 +281,30 @@ class ProtRelionMotioncor(ProtAlignMovies, ProtRelionBase):
 
         form.addParallelSection(threads=4, mpi=0)
 
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertNewMoviesSteps(self, insertedDict, inputMovies):
+        """ Group new movies in batches if requested. """
+        newMovies = [m.clone() for m in inputMovies
+                     if m.getObjId() not in insertedDict]
+        self._prefetchMovies(newMovies)
+
+        batchSize = self.getAttributeValue('moviesPerBatch', 1)
+        if batchSize <= 1:
+            return ProtAlignMovies._insertNewMoviesSteps(self, insertedDict,
+                                                         newMovies)
+        deps = []
+        for i in range(0, len(newMovies), batchSize):
+            batch = newMovies[i:i + batchSize]
+            movieDicts = [m.getObjDict(includeBasic=True) for m in batch]
+            stepId = self._insertFunctionStep('processMovieBatchStep',
+                                              self._storeStepArg(movieDicts),
+                                              batch[0].hasAlignment(),
+                                              prerequisites=self.convertCIStep)
+            deps.append(stepId)
+            for movie in batch:
+                insertedDict[movie.getObjId()] = stepId
+        return deps
+
     # --------------------------- STEPS functions -------------------------------
     def _convertInputStep(self):
         self.info("Relion version:")
@@ -226,77 +313,159 @@ class ProtRelionMotioncor(ProtAlignMovies, ProtRelionBase):
 
         ProtAlignMovies._convertInputStep(self)
 
+    def processMovieStep(self, movieDict, hasAlignment):
+        ProtAlignMovies.processMovieStep(self, movieDict, hasAlignment)
+        if self._batchMovies is None:
+            movie = Movie()
+            movie.setAttributesFromDict(movieDict, setBasic=True,
+                                        ignoreMissing=True)
+            if movie.getObjId() in self._extraFutures:
+                self._markMovieDone(movie)
+        # Movies of a batch are released after processing the whole batch
+        if self._prefetcher is not None and self._batchMovies is None:
+            self._prefetcher.release([movieDict['_filename']])
+
+    def processMovieBatchStep(self, movieDictList, hasAlignment):
+        """ Prepare all movies of the batch as it is done for a single
+        movie and then run relion_run_motioncorr once for all of them.
+        """
+        movies = self._batchMovies = []
+        movieDicts = self._loadStepArg(movieDictList)
+        try:
+            for movieDict in movieDicts:
+                self.processMovieStep(movieDict, hasAlignment)
+        finally:
+            self._batchMovies = None
+
+        # The base step marks each movie as done, but the
+        # movies are not done until the whole batch is processed
+        for movie in movies:
+            pwutils.cleanPath(self._getMovieDone(movie))
+
+        if movies:
+            self._processMovieBatch(movies)
+
+        for movie in movies:
+            self._cleanMovieFolder(self._getOutputMovieFolder(movie))
+            self._markMovieDone(movie)
+
+        if self._prefetcher is not None:
+            self._prefetcher.release([d['_filename'] for d in movieDicts])
+
     def _processMovie(self, movie):
+        if self._batchMovies is not None:
+            # Movies are processed together at the end of the batch step
+            self._batchMovies.append(movie)
+            return
+
         movieFolder = self._getOutputMovieFolder(movie)
         inputStar = os.path.join(movieFolder,
                                  '%s_input.star' % self._getMovieRoot(movie))
         pwutils.makePath(os.path.join(movieFolder, 'output'))
 
-        og = OpticsGroups.fromImages(self.inputMovies.get())
-        writer = convert.createWriter(optics=og)
+        if self._linkCachedOutput(movie):
+            try:
+                self._processMovieOutput(movie, cached=True)
+            except:
+                self.error(f"ERROR processing movie: {movie.getFileName()}")
+            return
+
         # Let's use only the basename, since we will launch the command
         # from the movieFolder
         movie.setFileName(os.path.basename(movie.getFileName()))
-        writer.writeSetOfMovies([movie], inputStar)
+        self._writeInputStar([movie], inputStar)
 
         # The program will run in the movie folder, so let's put
         # the input files relative to that
         args = "--i %s --o output/ " % os.path.basename(inputStar)
-        args += "--use_own --skip_logfile "
-        args += "--first_frame_sum %d --last_frame_sum %d " % (self._getFrameRange())
-        args += "--bin_factor %f --bfactor %d " % (self.binFactor, self.bfactor)
-        args += "--angpix %0.5f " % (movie.getSamplingRate())
-        args += "--patch_x %d --patch_y %d " % (self.patchX, self.patchY)
-        args += "--group_frames %d " % self.groupFrames
-        args += "--j %d " % self.numberOfThreads
-
-        inputMovies = self.inputMovies.get()
-        if inputMovies.getGain():
-            args += '--gainref "%s" ' % inputMovies.getGain()
-            args += '--gain_rot %d ' % self.gainRot
-            args += '--gain_flip %d ' % self.gainFlip
-
-        if self.defectFile.get():
-            args += '--defect_file "%s" ' % self.defectFile.get()
-
-        if self._savePsSum():
-            args += '--grouping_for_ps %d ' % self._calcPsDose()
+        args += self._getMotioncorArgs()
 
-        if self.doDW:
-            args += "--dose_weighting "
-            preExp, dose = self._getCorrectedDose(inputMovies)
-            # when using EER, the hardware frames are grouped
-            if self.isEER:
-                dose *= self.eerGroup.get()
-            args += "--dose_per_frame %f " % dose
-            args += "--preexposure %f " % preExp
-
-            if self.saveNonDW:
-                args += "--save_noDW "
-
-        if self.isEER:
-            args += "--eer_grouping %d " % self.eerGroup
-            args += "--eer_upsampling %d " % (self.eerSampling.get() + 1)
+        try:
+            self._runProgram('relion_run_motioncorr', args, cwd=movieFolder)
+            self._processMovieOutput(movie)
+        except:
+            self.error(f"ERROR processing movie: {movie.getFileName()}")
 
-        if self.saveFloat16:
-            args += "--float16 "
+    def _processMovieBatch(self, movies):
+        """ Run relion_run_motioncorr for several movies from the tmp folder
+        and split the outputs back into each movie folder.
+        """
+        newMovies = []
+        for movie in movies:
+            if self._linkCachedOutput(movie):
+                try:
+                    self._processMovieOutput(movie, cached=True)
+                except:
+                    self.error(f"ERROR processing movie: {movie.getFileName()}")
+            else:
+                newMovies.append(movie)
+
+        if not newMovies:
+            return
+        movies = newMovies
+
+        tmpDir = self._getTmpPath()
+        batchName = 'batch_%06d' % movies[0].getObjId()
+        inputStar = batchName + '_input.star'
+        self.info("Processing batch %s with %d movies"
+                  % (batchName, len(movies)))
+
+        for movie in movies:
+            pwutils.makePath(os.path.join(self._getOutputMovieFolder(movie),
+                                          'output'))
+            movie.setFileName(os.path.relpath(movie.getFileName(), tmpDir))
+        self._writeInputStar(movies, os.path.join(tmpDir, inputStar))
+
+        args = "--i %s --o %s/ " % (inputStar, batchName)
+        args += self._getMotioncorArgs()
 
-        if self.extraParams.hasValue():
-            args += " " + self.extraParams.get()
+        try:
+            self._runProgram('relion_run_motioncorr', args, cwd=tmpDir)
+        except:
+            self.error(f"ERROR processing batch: {batchName}")
 
+        batchFolder = os.path.join(tmpDir, batchName)
+        correctedStar = os.path.join(batchFolder, 'corrected_micrographs.star')
         try:
-            self._runProgram('relion_run_motioncorr', args, cwd=movieFolder)
+            correctedTable = md.Table(fileName=correctedStar,
+                                      tableName='micrographs')
+        except:
+            correctedTable = None
+
+        for movie in movies:
             try:
-                self._saveAlignmentPlots(movie, inputMovies.getSamplingRate())
-                self._computeExtra(movie)
+                self._splitBatchOutput(movie, batchFolder, correctedTable)
+                self._processMovieOutput(movie)
             except:
-                self.error("ERROR: Extra work "
-                           "(i.e plots, PSD, thumbnail) has failed for %s\n"
-                           % movie.getFileName())
+                self.error(f"ERROR processing movie: {movie.getFileName()}")
 
-            self._moveFiles(movie)
-        except:
-            self.error(f"ERROR processing movie: {movie.getFileName()}")
+        pwutils.cleanPath(batchFolder, os.path.join(tmpDir, inputStar))
+
+    def _splitBatchOutput(self, movie, batchFolder, correctedTable):
+        """ Move the outputs of this movie from the batch folder to the
+        movie output folder, where they are expected by _moveFiles.
+        """
+        movieDir = os.path.basename(self._getOutputMovieFolder(movie))
+        outputDir = os.path.join(self._getOutputMovieFolder(movie), 'output')
+        batchMovieDir = os.path.join(batchFolder, movieDir)
+
+        for fn in os.listdir(batchMovieDir):
+            pwutils.moveFile(os.path.join(batchMovieDir, fn), outputDir)
+
+        rows = [row for row in correctedTable
+                if '/%s/' % movieDir in '/' + row.rlnMicrographName]
+        table = md.Table(columns=correctedTable.getColumnNames())
+        for row in rows:
+            table.addRow(*row)
+        table.write(os.path.join(outputDir, 'corrected_micrographs.star'),
+                    tableName='micrographs')
+
+    def _processMovieOutput(self, movie, cached=False):
+        """ Generate the extra files and keep the results of this movie. """
+        if not cached:
+            self._storeCachedOutput(movie)
+        self._moveFiles(movie)
+        self._submitExtra(movie)
 
     # --------------------------- INFO functions ------------------------------
     def _summary(self):
@@ -355,15 +524,6 @@ class ProtRelionMotioncor(ProtAlignMovies, ProtRelionBase):
                           "EER movies. Please use *EER fractionation* option "
                           "instead.")
 
-        # check eman2 plugin
-        if self.doComputeMicThumbnail or self.doComputePSD:
-            try:
-                from pwem import Domain
-                _ = Domain.importFromPlugin('eman2', doRaise=True)
-            except:
-                errors.append("EMAN2 plugin not found!\nComputing thumbnails "
-                              "or PSD requires EMAN2 plugin and binaries installed.")
-
         return errors
 
     # ------------------------ Extra BASE functions ---------------------------
@@ -371,6 +531,10 @@ class ProtRelionMotioncor(ProtAlignMovies, ProtRelionBase):
         fn = self._getMovieRoot(movie) + postFix + '.' + ext
         return self._getExtraPath(fn) if extra else fn
 
+    def _doMovieFolderCleanUp(self):
+        # When processing batches, movie folders are cleaned after the batch
+        return self._batchMovies is None
+
     def _createOutputMovies(self):
         return True
 
@@ -394,29 +558,84 @@ class ProtRelionMotioncor(ProtAlignMovies, ProtRelionBase):
     def _setMotionValues(self, movie, mic):
         """ Parse motion values from the 'corrected_micrographs.star' file
         generated for each movie. """
-        fn = self._getMovieExtraFn(movie, 'corrected_micrographs.star')
-        table = md.Table(fileName=fn, tableName='micrographs')
-        row = table[0]
-        mic._rlnAccumMotionTotal = pwobj.Float(row.rlnAccumMotionTotal)
-        mic._rlnAccumMotionEarly = pwobj.Float(row.rlnAccumMotionEarly)
-        mic._rlnAccumMotionLate = pwobj.Float(row.rlnAccumMotionLate)
+        total, early, late = self._getMovieInfo(movie)['accumMotion']
+        mic._rlnAccumMotionTotal = pwobj.Float(total)
+        mic._rlnAccumMotionEarly = pwobj.Float(early)
+        mic._rlnAccumMotionLate = pwobj.Float(late)
 
     def _getMovieShifts(self, movie, outStarFn=None):
-        outStar = outStarFn or self._getMovieExtraFn(movie, '.star')
+        info = self._getMovieInfo(movie, outStarFn)
         first, last = self._getFrameRange()
-        n = last - first + 1
-        table = md.Table(fileName=outStar, tableName='global_shift')
-        xShifts, yShifts = [], []
-
-        for i, row in enumerate(table):
-            if i < first-1:
-                continue
-            # Shifts are in pixels of the original (unbinned) movies
-            xShifts.append(float(row.rlnMicrographShiftX))
-            yShifts.append(float(row.rlnMicrographShiftY))
-            if len(xShifts) == n:
-                break
-        return xShifts, yShifts
+        # Shifts are in pixels of the original (unbinned) movies
+        frames = slice(first - 1, last)
+        return (info['shiftsX'][frames].tolist(),
+                info['shiftsY'][frames].tolist())
+
+    def _getMovieInfo(self, movie, outStarFn=None):
+        """ Return the motion values of this movie, parsing its star
+        files only the first time they are requested.
+        """
+        movieId = movie.getObjId()
+        if movieId not in self._movieInfo:
+            self._movieInfo[movieId] = self._readMovieInfo(
+                outStarFn or self._getMovieExtraFn(movie, '.star'),
+                self._getMovieExtraFn(movie, 'corrected_micrographs.star'))
+        return self._movieInfo[movieId]
+
+    def _readMovieInfo(self, outStar, correctedStar):
+        """ Read all tables of the movie output star file in a single pass
+        and the motion values from the corrected micrographs star file.
+        """
+        tableNames = ['global_shift', 'local_motion_model', 'hot_pixels']
+        blocks = {}
+        lines = None
+        # Split the file in data blocks, keeping only the needed ones,
+        # so each table is parsed once from its own lines
+        with open(outStar) as f:
+            for line in f:
+                if line.startswith('data_'):
+                    tableName = line.strip()[5:]
+                    lines = [] if tableName in tableNames else None
+                    if lines is not None:
+                        blocks[tableName] = lines
+                if lines is not None:
+                    lines.append(line)
+
+        def _readTable(tableName):
+            if tableName not in blocks:
+                return None
+            table = md.Table()
+            table.readStar(io.StringIO(''.join(blocks[tableName])),
+                           tableName=tableName)
+            return table
+
+        shifts = np.array([(row.rlnMicrographShiftX, row.rlnMicrographShiftY)
+                           for row in _readTable('global_shift')],
+                          dtype=float).reshape(-1, 2)
+
+        try:
+            coeffs = np.array([row.rlnMotionModelCoeff
+                               for row in _readTable('local_motion_model')])
+        except Exception:
+            coeffs = None  # Failed to parse the local motion
+
+        try:
+            hotPixels = np.array([(row.rlnCoordinateX, row.rlnCoordinateY)
+                                  for row in _readTable('hot_pixels')])
+        except Exception:
+            hotPixels = np.array([])
+
+        accumMotion = None
+        if os.path.exists(correctedStar):
+            row = md.Table(fileName=correctedStar, tableName='micrographs')[0]
+            accumMotion = (row.rlnAccumMotionTotal, row.rlnAccumMotionEarly,
+                           row.rlnAccumMotionLate)
+
+        return {'shiftsX': shifts[:, 0],
+                'shiftsY': shifts[:, 1],
+                'coeffs': coeffs,
+                'hotPixels': hotPixels,
+                'accumMotion': accumMotion}
 
     def _getBinFactor(self):
         if not self.isEER:
@@ -425,6 +644,164 @@ class ProtRelionMotioncor(ProtAlignMovies, ProtRelionBase):
             return self.binFactor.get() / (self.eerSampling.get() + 1)
 
     # --------------------------- UTILS functions -----------------------------
+    def _writeInputStar(self, movies, inputStar):
+        if getattr(self, '_inputOptics', None) is None:
+            self._inputOptics = OpticsGroups.fromImages(self.inputMovies.get())
+        writer = convert.createWriter(optics=self._inputOptics)
+        writer.writeSetOfMovies(movies, inputStar)
+
+    def _getMotioncorArgs(self):
+        """ Return the arguments common to all movies, without the
+        input and output options. They are computed only once.
+        """
+        if getattr(self, '_motioncorArgs', None) is not None:
+            return self._motioncorArgs
+
+        inputMovies = self.inputMovies.get()
+        args = "--use_own --skip_logfile "
+        args += "--first_frame_sum %d --last_frame_sum %d " % (self._getFrameRange())
+        args += "--bin_factor %f --bfactor %d " % (self.binFactor, self.bfactor)
+        args += "--angpix %0.5f " % (inputMovies.getSamplingRate())
+        args += "--patch_x %d --patch_y %d " % (self.patchX, self.patchY)
+        args += "--group_frames %d " % self.groupFrames
+        args += "--j %d " % self.numberOfThreads
+
+        if inputMovies.getGain():
+            args += '--gainref "%s" ' % inputMovies.getGain()
+            args += '--gain_rot %d ' % self.gainRot
+            args += '--gain_flip %d ' % self.gainFlip
+
+        if self.defectFile.get():
+            args += '--defect_file "%s" ' % self.defectFile.get()
+
+        if self._savePsSum():
+            args += '--grouping_for_ps %d ' % self._calcPsDose()
+
+        if self.doDW:
+            args += "--dose_weighting "
+            preExp, dose = self._getCorrectedDose(inputMovies)
+            # when using EER, the hardware frames are grouped
+            if self.isEER:
+                dose *= self.eerGroup.get()
+            args += "--dose_per_frame %f " % dose
+            args += "--preexposure %f " % preExp
+
+            if self.saveNonDW:
+                args += "--save_noDW "
+
+        if self.isEER:
+            args += "--eer_grouping %d " % self.eerGroup
+            args += "--eer_upsampling %d " % (self.eerSampling.get() + 1)
+
+        if self.saveFloat16:
+            args += "--float16 "
+
+        if self.extraParams.hasValue():
+            args += " " + self.extraParams.get()
+
+        self._motioncorArgs = args
+        return args
+
+    def _prefetchMovies(self, movies):
+        """ Read in advance the movies that will be processed next. """
+        prefetchSize = self.getAttributeValue('prefetchSize', 0)
+        if prefetchSize <= 0:
+            return
+
+        if self._prefetcher is None:
+            self._prefetcher = FilePrefetcher(int(prefetchSize * GB))
+        self._prefetcher.add(m.getFileName() for m in movies
+                             if not self._isMovieDone(m))
+
+    def _getCacheEntry(self, movie):
+        """ Return the cache folder for the results of this movie, keyed
+        by the movie file (path, size and modification time) and by the
+        motion correction arguments, or None if the cache is not used.
+        """
+        if not self.getAttributeValue('useCache', False):
+            return None
+
+        if getattr(self, '_cacheArgsKey', None) is None:
+            # The number of threads does not change the results, and the
+            # gain and defect files are identified by their content, since
+            # the same file can have different paths (e.g. a converted gain
+            # in the run folder) or be replaced keeping its path
+            args = re.sub(r'--j \d+ ', '', self._getMotioncorArgs())
+            args = re.sub(r'--(gainref|defect_file) "[^"]*" ', '', args)
+            args += ' version=%s' % Plugin.getActiveVersion()
+            for fn in [self.inputMovies.get().getGain(), self.defectFile.get()]:
+                args += ' file=%s' % (self._getFileChecksum(fn) if fn else None)
+            self._cacheArgsKey = hashlib.sha1(args.encode()).hexdigest()
+
+        movieFn = os.path.realpath(
+            movie.getAttributeValue('_originalFileName', movie.getFileName()))
+        st = os.stat(movieFn)
+        movieKey = '%s %d %d' % (movieFn, st.st_size, int(st.st_mtime))
+        cacheDir = self.getAttributeValue('cacheDir', '').strip()
+        return os.path.join(cacheDir or self._getExtraPath('cache'),
+                            self._cacheArgsKey,
+                            hashlib.sha1(movieKey.encode()).hexdigest())
+
+    @staticmethod
+    def _getFileChecksum(fn):
+        """ Return the sha1 of the file content. """
+        sha1 = hashlib.sha1()
+        with open(fn, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def _getCacheFiles(self, movie):
+        """ Return pairs of (output file, cached name) for this movie.
+        Cached names do not depend on the movie name, since the same
+        movie could be linked with different names.
+        """
+        outputDir = os.path.dirname(self._getMovieOutFn(movie, ''))
+        movieBase = os.path.basename(self._getMovieOutFn(movie, ''))
+        for fn in os.listdir(outputDir):
+            cachedFn = fn
+            if fn.startswith(movieBase):
+                cachedFn = CACHE_PREFIX + fn[len(movieBase):]
+            yield os.path.join(outputDir, fn), cachedFn
+
+    def _linkCachedOutput(self, movie):
+        """ Link the cached results of this movie into its output folder.
+        Return False if the movie results are not in the cache. """
+        entry = self._getCacheEntry(movie)
+        if entry is None or not os.path.exists(entry):
+            return False
+
+        outputDir = os.path.dirname(self._getMovieOutFn(movie, ''))
+        movieBase = os.path.basename(self._getMovieOutFn(movie, ''))
+        pwutils.makePath(outputDir)
+        for cachedFn in os.listdir(entry):
+            fn = cachedFn
+            if cachedFn.startswith(CACHE_PREFIX):
+                fn = movieBase + cachedFn[len(CACHE_PREFIX):]
+            pwutils.createAbsLink(os.path.abspath(os.path.join(entry, cachedFn)),
+                                  os.path.join(outputDir, fn))
+        self.info("Using cached results for movie: %s" % movie.getFileName())
+        return True
+
+    def _storeCachedOutput(self, movie):
+        """ Copy the results of this movie into the cache folder. """
+        try:
+            entry = self._getCacheEntry(movie)
+            if (entry is None or os.path.exists(entry)
+                    or not os.path.exists(self._getMovieOutFn(movie, '.mrc'))):
+                return
+            tmpEntry = '%s.tmp%d' % (entry, os.getpid())
+            pwutils.makePath(tmpEntry)
+            for fn, cachedFn in self._getCacheFiles(movie):
+                shutil.copy2(fn, os.path.join(tmpEntry, cachedFn))
+            try:
+                os.rename(tmpEntry, entry)
+            except OSError:  # Stored meanwhile from other run
+                pwutils.cleanPath(tmpEntry)
+        except Exception as e:
+            self.warning("Could not store results of %s in the cache: %s"
+                         % (movie.getFileName(), e))
+
     def _getMovieOutFn(self, movie, suffix):
         movieBase = pwutils.removeBaseExt(movie.getFileName()).replace('.', '_')
         return os.path.join(self._getOutputMovieFolder(movie), 'output',
@@ -450,29 +827,81 @@ class ProtRelionMotioncor(ProtAlignMovies, ProtRelionBase):
         if self.doComputeMicThumbnail:
             mic.thumbnail = Image(location=self._getOutputMicThumbnail(movie))
 
-    def _computeExtra(self, movie):
-        """ Compute thumbnail and PSD. """
-        outMicFn = self._getMovieOutFn(movie, '.mrc')
+    def _submitExtra(self, movie):
+        """ Compute alignment plot, thumbnail and PSD in background threads,
+        so they do not delay the processing of the next movies.
+        """
+        doPlot = not self.getAttributeValue('deferPlots', False)
+        if not (doPlot or self.doComputeMicThumbnail or self.doComputePSD):
+            return
 
-        if self.doComputeMicThumbnail:
-            self.computeThumbnail(outMicFn,
-                                  outputFn=self._getOutputMicThumbnail(movie))
-        if self.doComputePSD:
-            self._computePSD(outMicFn, outputFn=self._getPsdCorr(movie))
+        if self._extraPool is None:
+            self._extraPool = ThreadPoolExecutor(
+                max_workers=max(1, self.numberOfThreads.get() // 2))
+            self._plotRenderer = GlobalAlignmentPlot()
 
-    def _computePSD(self, inputFn, outputFn, scaleFactor=6):
-        """ Generate a thumbnail of the PSD with EMAN2"""
-        args = "%s %s " % (inputFn, outputFn)
-        args += "--process=math.realtofft --meanshrink %s " % scaleFactor
-        args += "--fixintscaling=sane"
+        shifts = None
+        if doPlot:
+            try:
+                shifts = self._getMovieShifts(movie)
+            except Exception as e:
+                self.error("ERROR: Failed to read shifts for %s: %s\n"
+                           % (movie.getFileName(), e))
+
+        self._extraFutures[movie.getObjId()] = self._extraPool.submit(
+            self._computeExtra, movie.clone(), shifts,
+            self.inputMovies.get().getSamplingRate())
+
+    def _markMovieDone(self, movie):
+        """ Write the DONE marker of the movie once its extra files have
+        been computed, so its micrograph is not added to the output
+        before its thumbnail, PSD and plot exist.
+        The extra work is waited for within the step, so a finished step
+        always has its DONE marker, even if the run is killed later on.
+        If the extra work raised, the error is propagated and the step
+        fails without marking the movie as done.
+        """
+        doneFn = self._getMovieDone(movie)
+        pwutils.cleanPath(doneFn)
+        future = self._extraFutures.pop(movie.getObjId(), None)
+        if future is not None:
+            future.result()
+        open(doneFn, 'w').close()
+
+    def _waitExtra(self):
+        """ Wait until all thumbnails and PSDs have been computed. """
+        if self._extraPool is not None:
+            self._extraPool.shutdown(wait=True)
+            self._extraPool = None
+
+    def _computeExtra(self, movie, shifts=None, pixSize=None):
+        """ Compute the alignment plot from the given shifts and
+        thumbnail and PSD from the output micrograph. """
+        if shifts is not None:
+            try:
+                self._saveAlignmentPlots(movie, pixSize, shifts)
+            except Exception as e:
+                self.error("ERROR: Alignment plot has failed for %s: %s\n"
+                           % (movie.getFileName(), e))
+
+        if self.doDW:
+            micFn = self._getExtraPath(self._getOutputMicWtName(movie))
+        else:
+            micFn = self._getExtraPath(self._getOutputMicName(movie))
 
-        from pwem import Domain
-        eman2 = Domain.importFromPlugin('eman2')
-        from pyworkflow.utils.process import runJob
-        runJob(self._log, eman2.Plugin.getProgram('e2proc2d.py'), args,
-               env=eman2.Plugin.getEnviron())
+        try:
+            if self.doComputeMicThumbnail:
+                computeMicThumbnail(micFn, self._getOutputMicThumbnail(movie))
+            if self.doComputePSD:
+                self._computePSD(micFn, outputFn=self._getPsdCorr(movie))
+        except Exception as e:
+            self.error("ERROR: Extra work "
+                       "(i.e PSD, thumbnail) has failed for %s: %s\n"
+                       % (movie.getFileName(), e))
 
-        return outputFn
+    def _computePSD(self, inputFn, outputFn, scaleFactor=6):
+        """ Generate a thumbnail of the PSD. """
+        return computeMicPsd(inputFn, outputFn, scaleFactor=scaleFactor)
 
     def _moveFiles(self, movie):
         # It really annoying that Relion default names changes if you use DW or not
@@ -500,42 +929,67 @@ class ProtRelionMotioncor(ProtAlignMovies, ProtRelionBase):
         fn = os.path.join(self._getOutputMovieFolder(movie), 'output', suffix)
         pwutils.moveFile(fn, self._getMovieExtraFn(movie, suffix))
 
-    def _saveAlignmentPlots(self, movie, pixSize):
+    def _saveAlignmentPlots(self, movie, pixSize, shifts=None):
         # Create plots and save as an image
-        shiftsX, shiftsY = self._getMovieShifts(movie, self._getMovieOutFn(movie, '.star'))
+        shiftsX, shiftsY = shifts or self._getMovieShifts(movie)
         first, _ = self._getFrameRange()
-        plotter = createGlobalAlignmentPlot(shiftsX, shiftsY, first, pixSize)
-        plotter.savefig(self._getPlotGlobal(movie))
-        plotter.close()
+        if self._plotRenderer is None:
+            self._plotRenderer = GlobalAlignmentPlot()
+        self._plotRenderer.save(shiftsX, shiftsY, first, pixSize,
+                                self._getPlotGlobal(movie))
+
+    def renderMissingPlots(self, renderer=None):
+        """ Render the global alignment plots of the output movies that
+        do not have it yet, e.g. when the plots were deferred.
+        The output set is opened again, so this can be called from a
+        background thread.
+        """
+        outputMovies = getattr(self, 'outputMovies', None)
+        if outputMovies is None:
+            return
+
+        renderer = renderer or GlobalAlignmentPlot()
+        pixSize = self.inputMovies.get().getSamplingRate()
+        movieSet = SetOfMovies(filename=outputMovies.getFileName())
+        try:
+            for movie in movieSet.iterItems():
+                plotFn = self._getPlotGlobal(movie)
+                if not os.path.exists(plotFn):
+                    alignment = movie.getAlignment()
+                    shiftsX, shiftsY = alignment.getShifts()
+                    first, _ = alignment.getRange()
+                    renderer.save(shiftsX, shiftsY, first, pixSize, plotFn)
+        finally:
+            movieSet.close()
 
     def _createOutputMovie(self, movie):
         """ Overwrite this function to store the Relion's specific
-        Motion model coefficients and Hot pixels.
+        Motion model coefficients and Hot pixels. They are written in a
+        .npz file and the movie only keeps its filename.
         """
         m = ProtAlignMovies._createOutputMovie(self, movie)
+        info = self._getMovieInfo(movie)
+        coeffs = np.array([])
         # Load local motion values only if the patches are more than one
         if self.patchX.get() > 2 and self.patchY.get() > 2:
-            try:
-                table = md.Table(fileName=self._getMovieExtraFn(movie, '.star'),
-                                 tableName='local_motion_model')
-                coeffs = [row.rlnMotionModelCoeff for row in table]
-            except:
+            coeffs = info['coeffs']
+            if coeffs is None:
                 self.warning(f"Failed to parse local motion from: "
                              f"{os.path.abspath(self._getMovieExtraFn(movie, '.star'))}")
-                coeffs = []  # Failed to parse the local motion
-            m._rlnMotionModelCoeff = pwobj.String(json.dumps(coeffs))
+                coeffs = np.array([])
 
-        try:
-            table = md.Table(fileName=self._getMovieExtraFn(movie, '.star'),
-                             tableName='hot_pixels')
-            hotPixels = [(row.rlnCoordinateX, row.rlnCoordinateY) for row in table]
-        except:
-            hotPixels = []
-        m._rlnHotPixels = pwobj.String(json.dumps(hotPixels))
+        motionFn = convert.writeMotionModel(
+            self._getMovieExtraFn(movie, '_motion.npz'),
+            coeffs, info['hotPixels'])
+        m._rlnMotionModelFile = pwobj.String(motionFn)
 
         return m
 
     def createOutputStep(self):
+        self._waitExtra()
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            self._prefetcher = None
         # This method is re-implemented here because a bug in the base protocol
         # where the outputMicrographs is used without check if it is produced.
         # validate that we have some output movies
@@ -559,6 +1013,12 @@ class ProtRelionMotioncor(ProtAlignMovies, ProtRelionBase):
             self.warning(pwutils.yellowStr("WARNING - Failed to align %d movies."
                                            % (inputSize - outputSize)))
 
+    def _updateOutputSets(self, newDone, streamMode):
+        ProtAlignMovies._updateOutputSets(self, newDone, streamMode)
+        # The motion values of these movies are not needed anymore
+        for movie in newDone:
+            self._movieInfo.pop(movie.getObjId(), None)
+
     def _updateOutputSet(self, outputName, outputSet,
                          state=pwobj.Set.STREAM_OPEN):
         """ Redefine this method to update optics info. """
@@ -671,3 +1131,117 @@ def createGlobalAlignmentPlot(meanX, meanY, first, pixSize):
     plotter.tightLayout()
 
     return plotter
+
+
+def meanShrink(data, factor):
+    """ Reduce the image size by averaging blocks of factor x factor pixels. """
+    h, w = data.shape
+    h, w = h - h % factor, w - w % factor
+    return data[:h, :w].reshape(h // factor, factor,
+                                w // factor, factor).mean(axis=(1, 3))
+
+
+def saveImagePng(data, outputFn, stdThreshold=3):
+    """ Save the 2D array as an 8-bit png, clipping values
+    beyond stdThreshold standard deviations from the mean. """
+    mean, std = data.mean(), data.std()
+    low = max(data.min(), mean - stdThreshold * std)
+    high = min(data.max(), mean + stdThreshold * std)
+    scaled = np.clip((data - low) / max(high - low, 1e-12), 0, 1)
+    PILImage.fromarray((scaled * 255).astype(np.uint8)).save(outputFn)
+    return outputFn
+
+
+def computeMicThumbnail(inputFn, outputFn, scaleFactor=6):
+    """ Write a shrunk png of the micrograph, reading it by memory mapping. """
+    with mrcfile.mmap(inputFn, mode='r', permissive=True) as mrc:
+        data = mrc.data[0] if mrc.data.ndim == 3 else mrc.data
+        thumb = meanShrink(data.astype(np.float32), scaleFactor)
+    return saveImagePng(thumb, outputFn)
+
+
+def computeMicPsd(inputFn, outputFn, scaleFactor=6):
+    """ Write a png of the micrograph power spectrum, averaging the
+    periodograms of half-overlapping tiles (Welch's method). The tile
+    size is the micrograph size divided by scaleFactor, giving the same
+    output size than the meanshrink of the full periodogram, while only
+    one tile is transformed at a time.
+    """
+    with mrcfile.mmap(inputFn, mode='r', permissive=True) as mrc:
+        data = mrc.data[0] if mrc.data.ndim == 3 else mrc.data
+        h, w = data.shape
+        tile = max(16, min(h, w) // scaleFactor) // 2 * 2
+        step = tile // 2
+        window = np.outer(np.hanning(tile), np.hanning(tile)).astype(np.float32)
+        ps = np.zeros((tile, tile))
+        count = 0
+
+        for y in range(0, h - tile + 1, step):
+            for x in range(0, w - tile + 1, step):
+                t = np.array(data[y:y + tile, x:x + tile], dtype=np.float32)
+                t -= t.mean()
+                t *= window
+                ps += np.abs(np.fft.fft2(t)) ** 2
+                count += 1
+
+    ps = np.log1p(np.fft.fftshift(ps / max(count, 1)))
+    return saveImagePng(ps, outputFn)
+
+
+class GlobalAlignmentPlot:
+    """ Render global alignment plots as createGlobalAlignmentPlot, but
+    reusing the same figure and artists for all movies, which is much
+    faster than creating a new figure every time.
+    """
+    def __init__(self, figureSize=(6, 4)):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self._lock = threading.Lock()
+        self.figure = Figure(figsize=figureSize)
+        FigureCanvasAgg(self.figure)
+
+        self.axPx = ax = self.figure.add_subplot(111)
+        ax.grid()
+        ax.set_xlabel('Shift x (px)')
+        ax.set_ylabel('Shift y (px)')
+        self.axAngX = ax.twiny()
+        self.axAngX.set_xlabel('Shift x (A)')
+        self.axAngY = ax.twinx()
+        self.axAngY.set_ylabel('Shift y (A)')
+
+        self.line, = ax.plot([], [], color='b')
+        self.points, = ax.plot([], [], 'yo')
+        self.start, = ax.plot([], [], 'ro', markersize=10, linewidth=0.5)
+        ax.set_title('Global frame alignment')
+        self.labels = []
+
+    def save(self, shiftsX, shiftsY, first, pixSize, outputFn):
+        """ Plot the shift per frame and save the figure in outputFn. """
+        with self._lock:
+            for label in self.labels:
+                label.remove()
+            # The output _rlnMicrographShiftX/Y shifts relative to the first frame.
+            # Unit is pixels of the original (unbinned) movies (Takanori, 2018)
+            skipLabels = max(1, ceil(len(shiftsX) / 10.0))
+            self.labels = [self.axPx.text(shiftsX[i] - 0.02, shiftsY[i] + 0.02,
+                                          str(first + i))
+                           for i in range(0, len(shiftsX), skipLabels)]
+
+            self.line.set_data(shiftsX, shiftsY)
+            self.points.set_data(shiftsX, shiftsY)
+            self.start.set_data(shiftsX[:1], shiftsY[:1])
+
+            self.axPx.relim()
+            self.axPx.autoscale_view()
+            x1, x2 = self.axPx.get_xlim()
+            y1, y2 = self.axPx.get_ylim()
+            self.axAngX.set_xlim(x1 * pixSize, x2 * pixSize)
+            self.axAngY.set_ylim(y1 * pixSize, y2 * pixSize)
+
+            self.figure.tight_layout()
+            # Write with a temporary name, so an interrupted rendering
+            # does not leave an incomplete plot
+            tmpFn = outputFn + '.tmp'
+            self.figure.savefig(tmpFn, format=os.path.splitext(outputFn)[1][1:])
+            os.replace(tmpFn, outputFn)
@@ -26,6 +26,7 @@
 from enum import Enum
 
 import pyworkflow.utils as pwutils
+from pyworkflow.object import Boolean
 from pyworkflow.protocol.params import (PointerParam, BooleanParam,
                                         FloatParam, IntParam, Positive)
 from pyworkflow.protocol import STEPS_PARALLEL
@@ -122,6 +123,12 @@ class ProtRelionPreprocessParticles(ProtProcessParticles, ProtRelionBase):
                       label='Window size (px)',
                       help='New particles windows size (in pixels).')
 
+        form.addParam('saveFloat16', BooleanParam, default=False,
+                      label="Write output in float16?",
+                      help="Relion can write output images in float16 "
+                           "MRC (mode 12) format to save disk space. "
+                           "By default, float32 format is used.")
+
         form.addParallelSection(threads=4, mpi=1)
     
     # --------------------------- INSERT steps functions ----------------------
@@ -167,6 +174,9 @@ class ProtRelionPreprocessParticles(ProtProcessParticles, ProtRelionBase):
         if self.doWindow:
             args += ' --window %d' % self.windowSize
 
+        if self.saveFloat16:
+            args += ' --float16'
+
         return args
 
     def processStep(self, objId, stack, args):
@@ -184,6 +194,7 @@ class ProtRelionPreprocessParticles(ProtProcessParticles, ProtRelionBase):
             imgSet = self._createSetOfParticles()
         
         imgSet.copyInfo(inputSet)
+        imgSet._mrcFloat16 = Boolean(self.saveFloat16.get())
 
         if self.doScale:
             oldSampling = inputSet.getSamplingRate()
@@ -236,6 +247,8 @@ class ProtRelionPreprocessParticles(ProtProcessParticles, ProtRelionBase):
                     '- Removed black dust (sigma=%0.3f)' % self.blackDust.get())
         if self.doInvert:
             summary.append('- Inverted contrast')
+        if self.saveFloat16:
+            summary.append('- Written in float16')
         
         return summary
     
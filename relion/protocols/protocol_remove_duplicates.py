@@ -0,0 +1,204 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from enum import Enum
+
+import numpy as np
+
+import pyworkflow.protocol.params as params
+from pyworkflow.constants import PROD
+from pwem.constants import ALIGN_PROJ, ALIGN_2D
+from pwem.protocols import ProtProcessParticles
+from pwem.objects import SetOfParticles
+
+import relion.convert as convert
+
+
+class outputs(Enum):
+    outputParticles = SetOfParticles
+
+
+class ProtRelionRemoveDuplicates(ProtProcessParticles):
+    """ Remove duplicated particles after refinement.
+
+    Particles picked twice end up at the same position once their refined
+    shifts are applied. For each micrograph, the refined centres
+    (coordinate minus origin shift) closer than the given distance are
+    considered the same particle and only one of them is kept.
+
+    Copies of the same image (e.g. after symmetry expansion) are kept or
+    removed together, they are never considered duplicates of each other.
+    """
+    _label = 'remove duplicates'
+    _devStatus = PROD
+    _possibleOutputs = outputs
+
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputParticles', params.PointerParam,
+                      pointerClass='SetOfParticles',
+                      pointerCondition='hasAlignment',
+                      important=True,
+                      label='Input particles',
+                      help='Particles with alignment and coordinates.')
+        form.addParam('minDistance', params.FloatParam, default=30,
+                      validators=[params.Positive],
+                      label='Minimum inter-particle distance (A)',
+                      help='Particles of the same micrograph whose refined '
+                           'centres are closer than this distance are '
+                           'considered duplicates.')
+        form.addParam('scoreAttribute', params.StringParam, default='',
+                      label='Score attribute',
+                      help='Attribute of the particles used to choose which '
+                           'duplicate is kept, the one with the highest '
+                           'value is kept (e.g. _rlnMaxValueProbDistribution '
+                           'or _rlnLogLikeliContribution). If empty or not '
+                           'present, the particle with the lowest id is kept.')
+
+    # -------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep(self.createOutputStep)
+
+    def createOutputStep(self):
+        imgSet = self.inputParticles.get()
+        self.removedIds = self._findDuplicates(imgSet)
+        self.info("Removing %d duplicated particles" % len(self.removedIds))
+
+        outImgSet = self._createSetOfParticles()
+        outImgSet.copyInfo(imgSet)
+        outImgSet.copyItems(imgSet, updateItemCallback=self._removeDuplicates)
+        self._defineOutputs(**{outputs.outputParticles.name: outImgSet})
+        self._defineTransformRelation(self.inputParticles, outImgSet)
+
+    def _removeDuplicates(self, item, row):
+        if item.getObjId() in self.removedIds:
+            setattr(item, "_appendItem", False)
+
+    # --------------------------- INFO functions ------------------------------
+    def _summary(self):
+        summary = []
+
+        if hasattr(self, outputs.outputParticles.name):
+            inputSize = self.inputParticles.get().getSize()
+            outputSize = self.outputParticles.getSize()
+            summary.append("Input particles: %d" % inputSize)
+            summary.append("Output particles: %d" % outputSize)
+            summary.append("Removed duplicates (< %0.1f A): %d"
+                           % (self.minDistance, inputSize - outputSize))
+
+        return summary
+
+    def _validate(self):
+        errors = []
+
+        imgSet = self.inputParticles.get()
+        if imgSet is not None:
+            first = imgSet.getFirstItem()
+            if not first.hasCoordinate():
+                errors.append("Input particles do not have coordinates.")
+            elif self._getMicKey(first) is None:
+                errors.append("Input particles do not have micrograph ids "
+                              "or names, duplicates can not be grouped by "
+                              "micrograph.")
+
+        return errors
+
+    # -------------------------- UTILS functions ------------------------------
+    def _getMicKey(self, part):
+        """ Return the key used to group the particles by micrograph:
+        the micrograph id or, if not set, the micrograph name. """
+        coord = part.getCoordinate()
+        micId = part.getMicId() or (coord.getMicId() if coord else None)
+        if micId:
+            return micId
+        micName = coord.getMicName() if coord else None
+        return micName or None
+
+    def _loadCentres(self, imgSet):
+        """ Return arrays with the id, micrograph index, image index, refined
+        centre (in pixels) and score of the particles with coordinates. """
+        n = imgSet.getSize()
+        ids = np.zeros(n, dtype=np.int64)
+        micIds = np.zeros(n, dtype=np.int64)
+        imgIdx = np.zeros(n, dtype=np.int64)
+        centres = np.zeros((n, 2))
+        scores = np.full(n, -np.inf)
+        imgDict = {}
+        micDict = {}
+        alignProj = imgSet.getAlignment() == ALIGN_PROJ
+        align2D = imgSet.getAlignment() == ALIGN_2D
+        scoreAttr = self.scoreAttribute.get('').strip()
+        count = 0
+
+        for part in imgSet.iterItems():
+            coord = part.getCoordinate()
+            if coord is None or coord.getX() is None:
+                continue
+            shifts = (0., 0.)
+            if alignProj or align2D:
+                m = part.getTransform().getMatrix()
+                # Relion origin of the particle in pixels
+                shifts = m[:3, :3].T @ m[:3, 3] if alignProj else m[:2, 3]
+            micKey = self._getMicKey(part)
+            if micKey is None:
+                raise ValueError("Particle %d has no micrograph id or name."
+                                 % part.getObjId())
+            ids[count] = part.getObjId()
+            micIds[count] = micDict.setdefault(micKey, len(micDict))
+            imgIdx[count] = imgDict.setdefault(part.getLocation(), len(imgDict))
+            centres[count] = (coord.getX() - shifts[0],
+                              coord.getY() - shifts[1])
+            if scoreAttr:
+                score = part.getAttributeValue(scoreAttr)
+                if score is not None:
+                    scores[count] = score
+            count += 1
+
+        return (ids[:count], micIds[:count], imgIdx[:count],
+                centres[:count], scores[:count])
+
+    def _findDuplicates(self, imgSet):
+        """ Return the set of ids of the duplicated particles. """
+        ids, micIds, imgIdx, centres, scores = self._loadCentres(imgSet)
+        if not len(ids):
+            return set()
+
+        # Use one entry per image with its first centre and best score,
+        # so the copies of the same image are kept or removed together
+        _, first, inverse = np.unique(imgIdx, return_index=True,
+                                      return_inverse=True)
+        imgScores = np.full(len(first), -np.inf)
+        np.maximum.at(imgScores, inverse, scores)
+        imgCentres = centres[first]
+        imgCentres -= imgCentres.min(axis=0)
+
+        # Move each micrograph far away from the others on the x axis,
+        # so all micrographs are processed with a single spatial hash
+        minDistance = self.minDistance.get() / imgSet.getSamplingRate()
+        span = imgCentres[:, 0].max() + 2 * minDistance + 1
+        micIdx = np.unique(micIds[first], return_inverse=True)[1]
+        imgCentres[:, 0] += micIdx * span
+
+        keep = convert.removeNearDuplicates(imgCentres, imgScores, minDistance)
+        return set(ids[~keep[inverse]].tolist())
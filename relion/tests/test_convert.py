@@ -35,7 +35,8 @@ from pyworkflow.tests import BaseTest, setupTestOutput, DataSet
 from pyworkflow.utils import cleanPath, magentaStr, createLink, replaceExt
 from pwem.objects import (SetOfParticles, CTFModel, Acquisition,
                           SetOfMicrographs, Coordinate, Particle,
-                          SetOfVolumes, Transform)
+                          SetOfVolumes, Transform, Micrograph,
+                          SetOfCoordinates)
 from pwem.emlib.image import ImageHandler
 import pwem.emlib.metadata as md
 from pwem.constants import ALIGN_PROJ, ALIGN_2D, ALIGN_3D
@@ -837,6 +838,63 @@ class TestRelionReader(BaseTest):
         self.assertEqual(coord.getMicName(), 'Falcon_2012_06_12-14_33_35_0_movie.mrcs')
 
 
+class TestReadCoordinateFiles(BaseTest):
+    nFiles = 2 * convert.COORD_FILES_PER_PROCESS
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _writeCoordsStar(self, fn, hasFom):
+        table = Table(columns=['rlnCoordinateX', 'rlnCoordinateY'] +
+                              (['rlnAutopickFigureOfMerit'] if hasFom else []))
+        for i in range(3):
+            table.addRow(10 * i, 20 * i, *([0.5] if hasFom else []))
+        table.write(fn)
+
+    def _readCoords(self, numberOfThreads):
+        micSet = SetOfMicrographs(
+            filename=self.getOutputPath('mics_%d.sqlite' % numberOfThreads))
+        micSet.setSamplingRate(1.)
+        coordFiles = []
+        # Only some of the files have the figure-of-merit column, with
+        # enough files to be read by several processes
+        for i in range(self.nFiles):
+            hasFom = i % 2 == 0
+            mic = Micrograph(location='mic_%d.mrc' % i)
+            mic.setMicName('mic_%d.mrc' % i)
+            micSet.append(mic)
+            coordFn = self.getOutputPath('mic_%d_autopick.star' % i)
+            self._writeCoordsStar(coordFn, hasFom)
+            coordFiles.append(coordFn)
+        micSet.write()
+
+        coordsFn = self.getOutputPath('coords_%d.sqlite' % numberOfThreads)
+        coordSet = SetOfCoordinates(filename=coordsFn)
+        coordSet.setMicrographs(micSet)
+        coordSet.setBoxSize(10)
+        convert.readCoordinateFiles(coordSet, [m.clone() for m in micSet],
+                                    coordFiles,
+                                    numberOfThreads=numberOfThreads)
+        coordSet.write()
+        coordSet.close()
+
+        return SetOfCoordinates(filename=coordsFn)
+
+    def test_readCoordinateFiles(self):
+        for numberOfThreads in [1, 3]:
+            coordSet = self._readCoords(numberOfThreads)
+            self.assertEqual(coordSet.getSize(), 3 * self.nFiles)
+
+            for coord in coordSet:
+                fom = coord.getAttributeValue('_rlnAutopickFigureOfMerit')
+                # Coordinates from files without the column have no value
+                if coord.getMicId() % 2:
+                    self.assertAlmostEqual(fom, 0.5)
+                else:
+                    self.assertIsNone(fom)
+
+
 class TestRelionOpticsGroups(BaseTest):
     @classmethod
     def setUpClass(cls):
@@ -0,0 +1,127 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import time
+import multiprocessing
+from collections import Counter
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from relion.file_queue import FileQueue
+
+
+class TestFileQueue(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _createQueue(self, name, **kwargs):
+        queue = FileQueue(self.getOutputPath(name), **kwargs)
+        queue.create()
+        workDir = self.getOutputPath(name + '_work')
+        os.makedirs(workDir, exist_ok=True)
+        runsFn = os.path.join(workDir, 'runs.txt')
+        if os.path.exists(runsFn):
+            os.remove(runsFn)
+        return queue, workDir, runsFn
+
+    def _submit(self, queue, workDir, taskIds):
+        # Each task appends its id to the runs file
+        for taskId in taskIds:
+            queue.submit(taskId, 'echo', '%s >> runs.txt' % taskId, workDir)
+
+    def _startWorkers(self, queue, n):
+        workers = [multiprocessing.Process(target=queue.work,
+                                           kwargs={'sleep': 0.1})
+                   for _ in range(n)]
+        for w in workers:
+            w.start()
+        return workers
+
+    def _readRuns(self, runsFn):
+        with open(runsFn) as f:
+            return Counter(line.strip() for line in f if line.strip())
+
+    def test_workers(self):
+        """ Several worker processes run each task exactly once. """
+        queue, workDir, runsFn = self._createQueue('queue_workers')
+        taskIds = ['task_%03d' % i for i in range(40)]
+        self._submit(queue, workDir, taskIds)
+        workers = self._startWorkers(queue, 4)
+
+        for taskId in taskIds:
+            result = queue.wait(taskId, sleep=0.1, timeout=60)
+            self.assertEqual(result['returnCode'], 0)
+            self.assertEqual(result['attempts'], 1)
+
+        queue.stop()
+        for w in workers:
+            w.join(timeout=30)
+            self.assertEqual(w.exitcode, 0)
+
+        runs = self._readRuns(runsFn)
+        self.assertEqual(set(runs), set(taskIds))
+        self.assertTrue(all(count == 1 for count in runs.values()))
+
+    def test_lostClaim(self):
+        """ A task claimed by a dead worker is queued again. """
+        queue, workDir, runsFn = self._createQueue('queue_lost',
+                                                   leaseTimeout=1)
+        self._submit(queue, workDir, ['task_lost'])
+        # Claim the task without running it, as a worker that died
+        self.assertEqual(queue.claim()['id'], 'task_lost')
+        self.assertIsNone(queue.claim())
+        time.sleep(1.5)
+
+        workers = self._startWorkers(queue, 2)
+        result = queue.wait('task_lost', sleep=0.1, timeout=60)
+        queue.stop()
+        for w in workers:
+            w.join(timeout=30)
+
+        self.assertEqual(result['returnCode'], 0)
+        self.assertEqual(result['attempts'], 2)
+        self.assertEqual(self._readRuns(runsFn), {'task_lost': 1})
+
+    def test_timeout(self):
+        """ Waiting without workers times out and removes the task. """
+        queue, workDir, _ = self._createQueue('queue_timeout')
+        self._submit(queue, workDir, ['task_timeout'])
+
+        with self.assertRaises(TimeoutError):
+            queue.wait('task_timeout', sleep=0.1, timeout=0.5)
+        self.assertIsNone(queue.claim())
+
+    def test_create(self):
+        """ Creating the queue removes the tasks of a previous run. """
+        queue, workDir, _ = self._createQueue('queue_create')
+        self._submit(queue, workDir, ['task_old1', 'task_old2'])
+        queue.claim()
+        queue.stop()
+
+        queue.create()
+        self.assertIsNone(queue.claim())
+        self.assertIsNone(queue.result('task_old1'))
+        self.assertFalse(queue.isStopped())
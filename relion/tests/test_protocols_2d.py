@@ -32,14 +32,18 @@ from glob import glob
 
 from pyworkflow.tests import setupTestProject, DataSet
 from pyworkflow.plugin import Domain
-from pyworkflow.utils import magentaStr
-from pwem.objects import SetOfMovies
+import pyworkflow.utils as pwutils
+from pyworkflow.utils import magentaStr, cleanPath
+from pwem.objects import (SetOfMovies, SetOfParticles, Particle,
+                          Coordinate, Transform, Acquisition)
+from pwem.emlib.image import ImageHandler
 from pwem.protocols import (ProtImportAverages, ProtImportCTF,
                             ProtImportParticles, ProtImportCoordinates)
 
 from ..protocols import *
 from ..convert import *
 from ..constants import *
+from relion.convert import removeNearDuplicates
 from relion.convert.convert31 import OpticsGroups
 from .test_protocols_base import TestRelionBase, USE_GPU, RUN_CPU, CPUS, MTF_FILE
 
@@ -141,6 +145,104 @@ _rlnOpticsGroup #2
             self.assertEqual(i + 1, movie.getAttributeValue('_rlnOpticsGroup'))
 
 
+class TestRelionAssignOpticsFromStar(TestRelionBase):
+    """ Assign optics groups from a star file to a small particle set,
+    updating the groups directly in the output sqlite. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.partsFn = cls.createParticles()
+        cls.starFn = cls.createOpticsStar()
+        cls.partsImport = cls.launchProtocol(cls.newProtocol(
+            ProtImportParticles,
+            importFrom=ProtImportParticles.IMPORT_FROM_SCIPION,
+            sqliteFile=cls.partsFn, samplingRate=1.0, magnification=60000))
+
+    @classmethod
+    def createParticles(cls):
+        """ Write 5 particles from 3 micrographs, the last micrograph
+        is not in the optics star file. """
+        stackFn = cls.proj.getPath('particles.mrcs')
+        ImageHandler().createEmptyImage(stackFn, xDim=16, yDim=16, nDim=5)
+        partsFn = cls.proj.getPath('particles.sqlite')
+        cleanPath(partsFn)
+        parts = SetOfParticles(filename=partsFn)
+        parts.setSamplingRate(1.0)
+        acq = Acquisition(voltage=300, sphericalAberration=2.7,
+                          amplitudeContrast=0.1, magnification=60000)
+        parts.setAcquisition(acq)
+        for i, micName in enumerate(['mic_a.mrc', 'mic_b.mrc', 'mic_c.mrc',
+                                     'mic_a.mrc', 'mic_b.mrc']):
+            part = Particle(location=(i + 1, stackFn))
+            part.setAcquisition(acq)
+            coord = Coordinate(x=100, y=100)
+            coord.setMicName(micName)
+            part.setCoordinate(coord)
+            parts.append(part)
+        parts.write()
+        parts.close()
+        return partsFn
+
+    @classmethod
+    def createOpticsStar(cls):
+        starFn = cls.proj.getPath('input_optics.star')
+        og = OpticsGroups.create(rlnImagePixelSize=1.0, rlnImageSize=16,
+                                 rlnVoltage=300., rlnSphericalAberration=2.7)
+        og.add(og.first()._replace(rlnOpticsGroup=2,
+                                   rlnOpticsGroupName='opticsGroup2'))
+        micTable = Table(columns=['rlnMicrographName', 'rlnOpticsGroup'])
+        micTable.addRow('mic_a.mrc', 1)
+        micTable.addRow('mic_b.mrc', 2)
+        with open(starFn, 'w') as f:
+            og.toStar(f)
+            micTable.writeStar(f, tableName='micrographs')
+        return starFn
+
+    def _checkGroups(self, partSet):
+        groups = {p.getObjId(): p.getAttributeValue('_rlnOpticsGroup')
+                  for p in partSet}
+        self.assertEqual(groups, {1: 1, 2: 2, 4: 1, 5: 2})
+
+    def test_bulkAssignGroups(self):
+        print(magentaStr("\n==> Testing relion - assign optics groups in the database:"))
+        inputParts = self.partsImport.outputParticles
+        prot = self.newProtocol(ProtRelionAssignOpticsGroup,
+                                inputType=1,  # from star file
+                                inputStar=self.starFn)
+        outputFn = self.proj.getPath('particles_groups.sqlite')
+        cleanPath(outputFn)
+        outputParts = SetOfParticles(filename=outputFn)
+        outputParts.copyInfo(inputParts)
+        micDict = {'mic_a.mrc': 1, 'mic_b.mrc': 2}
+        self.assertTrue(prot._bulkAssignGroups(inputParts, outputParts,
+                                               '_coordinate._micName',
+                                               micDict))
+        self.assertEqual(outputParts.getSize(), 4)
+        outputParts.write()
+        outputParts.close()
+
+        # Reload the updated database through pwem
+        outputParts = SetOfParticles(filename=outputFn)
+        self.assertEqual(outputParts.getSize(), 4)
+        self._checkGroups(outputParts)
+        self.assertEqual(outputParts[4].getCoordinate().getMicName(),
+                         'mic_a.mrc')
+        outputParts.close()
+
+    def test_fromStar(self):
+        print(magentaStr("\n==> Testing relion - assign optics groups (particles from star):"))
+        prot = self.newProtocol(ProtRelionAssignOpticsGroup,
+                                inputSet=self.partsImport.outputParticles,
+                                inputType=1,  # from star file
+                                inputStar=self.starFn)
+        self.launchProtocol(prot)
+
+        outputParts = prot.outputParticles
+        self.assertEqual(outputParts.getSize(), 4)
+        self.assertEqual(len(OpticsGroups.fromImages(outputParts)), 2)
+        self._checkGroups(outputParts)
+
+
 class TestRelionCenterAverages(TestRelionBase):
     @classmethod
     def setUpClass(cls):
@@ -685,6 +787,95 @@ class TestRelionImportParticles(TestRelionBase):
         self.checkOutput(prot1, 'outputClasses')
 
 
+class TestRelionMergeCoordinates(TestRelionBase):
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        for i in [1, 2]:
+            ImageHandler().createEmptyImage(cls.proj.getPath('mic_%d.mrc' % i),
+                                            xDim=256, yDim=256)
+        cls.protImportMics = cls.runImportMics(cls.proj.getPath('mic_*.mrc'),
+                                               1.0)
+
+    def _importCoords(self, label, coordsDict):
+        """ Write one star file per micrograph with rows of
+        (x, y, fom) and import them. """
+        coordsDir = self.proj.getPath(label)
+        pwutils.makePath(coordsDir)
+        for micName, rows in coordsDict.items():
+            table = Table(columns=['rlnCoordinateX', 'rlnCoordinateY',
+                                   'rlnAutopickFigureOfMerit',
+                                   'rlnClassNumber', 'rlnAnglePsi'])
+            for x, y, fom in rows:
+                table.addRow(x, y, fom, 0, -999.)
+            table.write(os.path.join(coordsDir, '%s_autopick.star' % micName))
+
+        protImport = self.newProtocol(ProtImportCoordinates,
+                                      objLabel=label,
+                                      importFrom=2,  # RELION
+                                      filesPath=coordsDir,
+                                      filesPattern="*autopick.star",
+                                      boxSize=32)
+        protImport.inputMicrographs.set(self.protImportMics.outputMicrographs)
+        self.launchProtocol(protImport)
+        return protImport.outputCoordinates
+
+    def test_removeNearDuplicates(self):
+        print(magentaStr("\n==> Testing relion - remove near duplicates"))
+        # Distance cut-off: only positions strictly closer are duplicates,
+        # (0, 0) is removed by (9.9, 0) but (20, 0) is kept
+        positions = np.array([[0, 0], [9.9, 0], [20, 0], [30, 0]])
+        keep = removeNearDuplicates(positions, [1, 2, 3, 4], 10)
+        self.assertEqual(keep.tolist(), [False, True, True, True])
+
+        # Equal scores keep the first position in the input order, and
+        # removed positions do not remove others
+        positions = np.array([[0, 0], [6, 0], [12, 0]])
+        keep = removeNearDuplicates(positions, [1, 1, 1], 10)
+        self.assertEqual(keep.tolist(), [True, False, True])
+
+        # Compare with greedy brute force on random positions
+        rng = np.random.default_rng(0)
+        for _ in range(50):
+            n = rng.integers(2, 200)
+            positions = rng.uniform(-100, 400, size=(n, 2))
+            scores = rng.integers(0, 5, size=n).astype(float)
+            minDistance = rng.uniform(1, 50)
+            expected = np.zeros(n, dtype=bool)
+            for i in np.argsort(-scores, kind='stable'):
+                dists = np.linalg.norm(positions[expected] - positions[i],
+                                       axis=1)
+                expected[i] = not np.any(dists < minDistance)
+            keep = removeNearDuplicates(positions, scores, minDistance)
+            self.assertEqual(keep.tolist(), expected.tolist())
+
+    def test_mergeCoordinates(self):
+        print(magentaStr("\n==> Testing relion - merge coordinates"))
+        coordsA = self._importCoords('coordsA', {
+            'mic_1': [(50, 50, 0.9), (150, 150, 0.2)],
+            'mic_2': [(50, 50, 0.5)]})
+        coordsB = self._importCoords('coordsB', {
+            'mic_1': [(52, 50, 0.3), (150, 153, 0.8)],
+            'mic_2': [(200, 200, 0.1)]})
+
+        prot = self.newProtocol(ProtRelionMergeCoordinates, minDistance=10)
+        prot.inputCoordinates.set([coordsA, coordsB])
+        self.launchProtocol(prot)
+
+        self.assertIsNotNone(prot.outputCoordinates,
+                             "There was a problem with merge coordinates protocol.")
+        micNames = {mic.getObjId(): mic.getMicName()
+                    for mic in self.protImportMics.outputMicrographs}
+        result = sorted((micNames[c.getMicId()], c.getX(), c.getY(),
+                         round(c._rlnAutopickFigureOfMerit.get(), 2))
+                        for c in prot.outputCoordinates)
+        # The same position in different micrographs is not a duplicate
+        self.assertEqual(result, [('mic_1.mrc', 50, 50, 0.9),
+                                  ('mic_1.mrc', 150, 153, 0.8),
+                                  ('mic_2.mrc', 50, 50, 0.5),
+                                  ('mic_2.mrc', 200, 200, 0.1)])
+
+
 class TestRelionMotioncor(TestRelionBase):
     @classmethod
     def setUpClass(cls):
@@ -871,6 +1062,91 @@ class TestRelionPreprocess(TestRelionBase):
         self._validations(protocol.outputParticles, 50, 7.0)
 
 
+class TestRelionRemoveDuplicates(TestRelionBase):
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.partsImport = cls.runImportParticlesSqlite(
+            cls.createParticles('particles'))
+        cls.partsNamesImport = cls.runImportParticlesSqlite(
+            cls.createParticles('particles_names', useMicNames=True))
+
+    @classmethod
+    def createParticles(cls, name, useMicNames=False):
+        """ Write a small set of particles with 2D alignment, where the
+        second particle is a duplicate of the first one only once its
+        shift is applied (refined centre = coordinate - shift).
+        If useMicNames, the micrographs are only identified by the
+        coordinates micrograph name (no micId). """
+        stackFn = cls.proj.getPath('%s.mrcs' % name)
+        ImageHandler().createEmptyImage(stackFn, xDim=16, yDim=16, nDim=5)
+        partsFn = cls.proj.getPath('%s.sqlite' % name)
+        cleanPath(partsFn)
+        parts = SetOfParticles(filename=partsFn)
+        parts.setSamplingRate(1.0)
+        parts.setAlignment2D()
+        acq = Acquisition(voltage=300, sphericalAberration=2.7,
+                          amplitudeContrast=0.1, magnification=60000)
+        parts.setAcquisition(acq)
+        # micId, x, y, shiftX, shiftY
+        partsInfo = [(1, 100, 100, 0, 0),  # kept
+                     (1, 130, 100, 30, 0),  # centre at (100, 100), removed
+                     (1, 200, 200, 0, 0),  # kept
+                     (2, 100, 100, 0, 0),  # same position, other mic, kept
+                     (2, 100, 100, -30, 0)]  # centre at (130, 100), kept
+        for i, (micId, x, y, shiftX, shiftY) in enumerate(partsInfo):
+            part = Particle(location=(i + 1, stackFn))
+            part.setAcquisition(acq)
+            coord = Coordinate(x=x, y=y)
+            if useMicNames:
+                coord.setMicName('mic_%03d.mrc' % micId)
+            else:
+                coord.setMicId(micId)
+                part.setMicId(micId)
+            part.setCoordinate(coord)
+            transform = Transform()
+            transform.setShifts(shiftX, shiftY, 0)
+            part.setTransform(transform)
+            parts.append(part)
+        parts.write()
+        parts.close()
+
+        return partsFn
+
+    @classmethod
+    def runImportParticlesSqlite(cls, partsFn):
+        print(magentaStr("\n==> Importing data - particles from sqlite:"))
+        protImport = cls.newProtocol(ProtImportParticles,
+                                     importFrom=ProtImportParticles.IMPORT_FROM_SCIPION,
+                                     sqliteFile=partsFn,
+                                     samplingRate=1.0,
+                                     magnification=60000)
+        cls.launchProtocol(protImport)
+        return protImport
+
+    def _runRemoveDuplicates(self, inputParts):
+        prot = self.newProtocol(ProtRelionRemoveDuplicates,
+                                inputParticles=inputParts,
+                                minDistance=10)
+        self.launchProtocol(prot)
+
+        self.assertIsNotNone(prot.outputParticles,
+                             "There was a problem with remove duplicates protocol.")
+        outputIds = [p.getObjId() for p in prot.outputParticles]
+        self.assertEqual(outputIds, [1, 3, 4, 5])
+
+    def test_removeDuplicates(self):
+        print(magentaStr("\n==> Testing relion - remove duplicates"))
+        self._runRemoveDuplicates(self.partsImport.outputParticles)
+
+    def test_removeDuplicatesMicNames(self):
+        print(magentaStr("\n==> Testing relion - remove duplicates "
+                         "grouped by micrograph name"))
+        parts = self.partsNamesImport.outputParticles
+        self.assertFalse(parts.getFirstItem().getMicId())
+        self._runRemoveDuplicates(parts)
+
+
 class TestRelionRemovePrefViews(TestRelionBase):
     @classmethod
     def setUpClass(cls):
@@ -24,14 +24,17 @@
 # *
 # ******************************************************************************
 
+import threading
+
 from pyworkflow.utils import cleanPath
 from pyworkflow.viewer import DESKTOP_TKINTER, WEB_DJANGO
-from pyworkflow.protocol.params import LabelParam
+from pyworkflow.protocol.params import LabelParam, IntParam
 from pwem.viewers import MicrographsView, EmProtocolViewer, EmPlotter
 import pwem.viewers.showj as showj
 from pwem.objects import SetOfMovies
 
 from ..protocols import ProtRelionMotioncor
+from ..protocols.protocol_motioncor import createGlobalAlignmentPlot
 
 
 class RelionMotioncorrViewer(EmProtocolViewer):
@@ -65,12 +68,19 @@ class RelionMotioncorrViewer(EmProtocolViewer):
                       label="Plot motion per frame", default=True,
                       help="Show accumulated motion for all micrographs. "
                            "Early motion default cut-off is 4 e/A2.")
+        form.addParam('movieId', IntParam, default=1,
+                      label='Movie id',
+                      help="Id of the movie to plot its global alignment.")
+        form.addParam('doShowAlignment', LabelParam,
+                      label="Plot global alignment of movie",
+                      help="Show the shifts per frame of the selected movie.")
 
     def _getVisualizeDict(self):
         self._errors = []
         visualizeDict = {'doShowMovies': self._viewParam,
                          'doShowFailedMovies': self._viewParam,
                          'doShowMotion': self._plotMotion,
+                         'doShowAlignment': self._plotAlignment,
                          }
         if self.hasMics():
             visualizeDict.update({'doShowMics': self._viewParam})
@@ -94,6 +104,9 @@ class RelionMotioncorrViewer(EmProtocolViewer):
                          showj.VISIBLE: labelsDef,
                          showj.RENDER: None
                          }
+        if param in ['doShowMics', 'doShowMicsDW']:
+            self._renderDeferredPlots()
+
         if param == 'doShowMics':
             return [MicrographsView(self.getProject(),
                                     self.protocol.outputMicrographs)]
@@ -120,6 +133,19 @@ class RelionMotioncorrViewer(EmProtocolViewer):
                 self.createFailedMoviesSqlite(sqliteFn)
                 return [self.objectView(sqliteFn, viewParams=viewParamsDef)]
 
+    def _renderDeferredPlots(self):
+        """ Plots could have been deferred until now. Render the missing
+        ones in a background thread, so the micrographs are shown without
+        waiting for them (they appear when the view is refreshed). """
+        if not self.protocol.getAttributeValue('deferPlots', False):
+            return
+        thread = getattr(self.protocol, '_renderPlotsThread', None)
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=self.protocol.renderMissingPlots,
+                                      daemon=True)
+            self.protocol._renderPlotsThread = thread
+            thread.start()
+
     def createFailedMoviesSqlite(self, path):
         inputMovies = self.protocol.inputMovies.get()
         cleanPath(path)
@@ -158,3 +184,17 @@ class RelionMotioncorrViewer(EmProtocolViewer):
         else:
             return [self.errorMessage('Plot is available only when dose weighting is ON',
                                       title="Visualization error")]
+
+    def _plotAlignment(self, param=None):
+        outputMovies = getattr(self.protocol, 'outputMovies', None)
+        movie = None if outputMovies is None else outputMovies[self.movieId.get()]
+        if movie is None:
+            return [self.errorMessage('Movie %s not found in the output movies!'
+                                      % self.movieId.get(),
+                                      title="Visualization error")]
+
+        alignment = movie.getAlignment()
+        shiftsX, shiftsY = alignment.getShifts()
+        first, _ = alignment.getRange()
+        pixSize = self.protocol.inputMovies.get().getSamplingRate()
+        return [createGlobalAlignmentPlot(shiftsX, shiftsY, first, pixSize)]